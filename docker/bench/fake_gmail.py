@@ -0,0 +1,145 @@
+import base64
+import email
+import threading
+import time
+
+
+class _Request:
+    """Mimics an HttpRequest of googleapiclient."""
+
+    def __init__(self, gmail, func):
+        self.gmail = gmail
+        self.func = func
+
+    def execute(self):
+        with self.gmail.lock:
+            self.gmail.calls += 1
+        time.sleep(self.gmail.latency)
+        return self.func()
+
+
+class _Resource:
+    def __init__(self, gmail, mailbox):
+        self.gmail = gmail
+        self.mailbox = mailbox
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self.gmail, self.mailbox)
+
+    def labels(self):
+        return _Labels(self.gmail)
+
+
+class _Labels:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId):
+        return _Request(
+            self.gmail,
+            lambda: {"labels": [{"id": "INBOX", "name": "INBOX"}]},
+        )
+
+
+class _Messages:
+    def __init__(self, gmail, mailbox):
+        self.gmail = gmail
+        self.mailbox = mailbox
+
+    def list(self, userId, q=None, maxResults=100):
+        def run():
+            with self.gmail.lock:
+                inbox = [mid for mid, msg in self.mailbox.items() if msg["inbox"]]
+            result = {"resultSizeEstimate": len(inbox)}
+            if inbox:
+                result["messages"] = [{"id": mid} for mid in inbox[:maxResults]]
+            if len(inbox) > maxResults:
+                result["nextPageToken"] = "more"
+            return result
+
+        return _Request(self.gmail, run)
+
+    def get(self, userId, id):
+        return _Request(self.gmail, lambda: self.mailbox[id]["message"])
+
+    def modify(self, userId, id, body):
+        def run():
+            if "INBOX" in body.get("removeLabelIds", []):
+                with self.gmail.lock:
+                    self.mailbox[id]["inbox"] = False
+            return {"id": id}
+
+        return _Request(self.gmail, run)
+
+    def send(self, userId, body):
+        def run():
+            raw = base64.urlsafe_b64decode(body["raw"])
+            message = email.message_from_bytes(raw)
+            with self.gmail.lock:
+                self.gmail.sent.append((time.time(), message["subject"]))
+                sent_id = f"sent{len(self.gmail.sent)}"
+            return {"id": sent_id}
+
+        return _Request(self.gmail, run)
+
+
+class FakeGmail:
+    """
+    In-process stand-in for the Gmail API client. Every OAuth token
+    has its own mailbox, so several penpals can be served at once.
+    Replace googleapiclient's build with FakeGmail.build.
+    """
+
+    def __init__(self, latency=0.05):
+        """
+        :param latency: Latency of every API call in seconds.
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+        self.sent = []
+        self.calls = 0
+        self.counter = 0
+
+    def build(self, service_name, version, credentials=None, **kwargs):
+        with self.lock:
+            mailbox = self.mailboxes.setdefault(credentials.token, {})
+        return _Resource(self, mailbox)
+
+    def deliver(self, token, sender, to, subject, body):
+        """
+        Deliver a plain text message into the inbox of a mailbox.
+
+        :param token: OAuth token of the receiving mailbox.
+        :return: Message ID.
+        """
+        data = base64.urlsafe_b64encode(body.encode("utf-8")).decode()
+        with self.lock:
+            self.counter += 1
+            mid = f"msg{self.counter:08d}"
+            self.mailboxes.setdefault(token, {})[mid] = {
+                "inbox": True,
+                "message": {
+                    "id": mid,
+                    "payload": {
+                        "mimeType": "text/plain",
+                        "headers": [
+                            {"name": "From", "value": sender},
+                            {"name": "To", "value": to},
+                            {"name": "Subject", "value": subject},
+                            {"name": "Date", "value": time.ctime()},
+                        ],
+                        "body": {"data": data},
+                    },
+                },
+            }
+        return mid
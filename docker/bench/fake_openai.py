@@ -0,0 +1,153 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAI:
+    """
+    Local stand-in for the OpenAI chat completions and embeddings APIs.
+    Responses are generated from the request text after a configurable
+    latency, and a configurable share of the requests fail with a rate limit
+    error. Calls and tokens are counted per endpoint.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, reply_words=200):
+        """
+        :param latency: Mean response latency in seconds.
+        :param jitter: Maximum random deviation from the mean latency in seconds.
+        :param error_rate: Share of requests answered with HTTP 429.
+        :param reply_words: Length of the generated penpal replies in words.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.lock = threading.Lock()
+        self.stats = {"chat": 0, "embeddings": 0, "errors": 0, "tokens": 0}
+        self.server = None
+
+    @property
+    def api_base(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Start the server in a background thread on a free local port."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                status, body = fake.handle(self.path, request)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {key: 0 for key in self.stats}
+
+    def _count(self, key, tokens=0):
+        with self.lock:
+            self.stats[key] += 1
+            self.stats["tokens"] += tokens
+
+    def handle(self, path, request):
+        """
+        Answer a request.
+
+        :return: HTTP status and JSON response body.
+        """
+        time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            self._count("errors")
+            return 429, {
+                "error": {
+                    "message": "Rate limit reached (fake)",
+                    "type": "requests",
+                    "code": None,
+                }
+            }
+        if path.endswith("/chat/completions"):
+            return 200, self.chat(request)
+        if path.endswith("/embeddings"):
+            return 200, self.embeddings(request)
+        return 404, {"error": {"message": f"Unknown path {path}", "type": "invalid"}}
+
+    def chat(self, request):
+        prompt = request["messages"][-1]["content"]
+        words = re.findall(r"\w+", prompt)
+        if prompt.startswith("You are a penpal"):
+            content = " ".join(random.choice(words) for _ in range(self.reply_words))
+        else:
+            # Bullets and summaries: a few bullets made of words of the prompt
+            content = "\n".join(
+                "- " + " ".join(random.sample(words, min(8, len(words))))
+                for _ in range(5)
+            )
+        prompt_tokens = sum(len(msg["content"].split()) for msg in request["messages"])
+        completion_tokens = len(content.split())
+        self._count("chat", prompt_tokens + completion_tokens)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def embeddings(self, request):
+        texts = request["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(
+                hashlib.md5(text.encode("utf-8")).digest()[:4], "little"
+            )
+            rng = random.Random(seed)
+            data.append(
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": [rng.uniform(-1, 1) for _ in range(1536)],
+                }
+            )
+        tokens = sum(len(text.split()) for text in texts)
+        self._count("embeddings", tokens)
+        return {
+            "object": "list",
+            "data": data,
+            "model": request.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
@@ -0,0 +1,434 @@
+"""
+Offline benchmark of the AI and mailer services.
+
+The services run in-process against a local fake OpenAI server, a fake Gmail
+API and a local MongoDB (a throwaway mongod is started when the mongod binary
+is found, otherwise --mongo-uri must point to a disposable local server: the
+robomail database is dropped). A synthetic workload is delivered to the fake
+inboxes and the mailer and AI service are polled back-to-back until every
+mail has been replied to.
+
+    python run_bench.py run --label baseline --customers 20 --mails 200
+    python run_bench.py compare results/baseline-*.json results/new-*.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import glob
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import openai
+import pymongo
+from fake_gmail import FakeGmail
+from fake_openai import FakeOpenAI
+from pymongo import monitoring
+from workload import generate_workload
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DF_DIR = os.path.join(BENCH_DIR, "..", "df")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# Metrics shown by the compare command, and whether a higher value is better
+COMPARED = [
+    ("mails_per_min", True),
+    ("latency_p50", False),
+    ("latency_p99", False),
+    ("llm_calls_per_mail", False),
+    ("embedding_calls_per_mail", False),
+    ("tokens_per_mail", False),
+    ("mongo_round_trips_per_mail", False),
+    ("gmail_calls_per_mail", False),
+]
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the MongoDB commands (round trips) of every client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def started(self, event):
+        with self.lock:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        with self.lock:
+            self.counts = Counter()
+
+
+class NoSleep:
+    """Replaces the time module of a service to skip its throttling sleeps."""
+
+    time = staticmethod(time.time)
+
+    @staticmethod
+    def sleep(seconds):
+        pass
+
+
+def percentile(values, share):
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mongod(binary, workdir):
+    """
+    Start a throwaway mongod on a free local port.
+
+    :return: The mongod process and its connection URI.
+    """
+    dbpath = os.path.join(workdir, "db")
+    os.makedirs(dbpath)
+    port = free_port()
+    process = subprocess.Popen(
+        [binary, "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    uri = f"mongodb://127.0.0.1:{port}/robomail"
+    with pymongo.MongoClient(uri, serverSelectionTimeoutMS=30000) as client:
+        client.admin.command("ping")
+    return process, uri
+
+
+def stage_service(dockerfile, target):
+    """Copy the files of a service into target the same way its Dockerfile does."""
+    with open(dockerfile, "r", encoding="utf-8") as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == "COPY":
+                dst = os.path.join(target, os.path.relpath(parts[2], "/home/app"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy(os.path.join(DF_DIR, parts[1]), dst)
+
+
+# Modules that are identical in both services and must be imported only once
+# (the Prometheus metrics can be registered only once per process)
+SHARED_MODULES = {"metrics"}
+
+
+def load_service(stage_dir, module_name):
+    """
+    Import the main module of a staged service. Both services have their own
+    mongo_client package, so the modules of a service are forgotten after the
+    import. The service keeps its references to them.
+    """
+    sys.path.insert(0, stage_dir)
+    try:
+        return importlib.import_module(module_name)
+    finally:
+        sys.path.remove(stage_dir)
+        for name, module in list(sys.modules.items()):
+            if name in SHARED_MODULES:
+                continue
+            path = getattr(module, "__file__", None) or ""
+            if path.startswith(stage_dir) or name.split(".")[0] == "mongo_client":
+                del sys.modules[name]
+
+
+def seed_personas(uri, penpals):
+    """Store the bench personas with long-lived fake OAuth tokens."""
+    with pymongo.MongoClient(uri) as client:
+        client.drop_database("robomail")
+        client.robomail.personas.insert_many(
+            [
+                {
+                    "_id": f"benchpal{p}",
+                    "name": f"Benchpal {p}",
+                    "email": f"benchpal{p}@example.com",
+                    "oauth_service": f"bench{p}",
+                    "token": {
+                        "token": f"token-benchpal{p}",
+                        "refresh_token": "bench",
+                        "client_id": "bench",
+                        "client_secret": "bench",
+                        "token_uri": "http://127.0.0.1:9/token",
+                        "expiry": "2099-01-01T00:00:00Z",
+                    },
+                }
+                for p in range(penpals)
+            ]
+        )
+
+
+def run(args):
+    counter = CommandCounter()
+    monitoring.register(counter)
+
+    workdir = tempfile.mkdtemp(prefix="robofriend-bench-")
+    mongod = None
+    uri = args.mongo_uri
+    if uri is None:
+        binary = args.mongod or shutil.which("mongod")
+        if binary is None:
+            sys.exit("mongod not found: pass --mongod or --mongo-uri")
+        mongod, uri = start_mongod(binary, workdir)
+    elif urlparse(uri).hostname not in ("localhost", "127.0.0.1", "::1"):
+        sys.exit("The benchmark drops the robomail database: use a local MongoDB")
+
+    fake_openai = FakeOpenAI(
+        args.llm_latency, args.llm_jitter, args.llm_error_rate, args.reply_words
+    ).start()
+    gmail = FakeGmail(args.gmail_latency)
+
+    try:
+        seed_personas(uri, args.penpals)
+        os.environ.update(
+            {
+                "MAIL_DB_URI": uri,
+                "PENPAL_ID": "benchpal0",
+                "PENPAL_NAME": "Benchpal 0",
+                "PENPAL_EMAIL": "benchpal0@example.com",
+                "OAUTH_SERVICE": "bench0",
+                "REPLY_POLLING_INTERVAL": "1",
+                "EMAIL_POLLING_INTERVAL": "1",
+                "REPLY_BATCH_SIZE": str(args.reply_batch_size),
+                "MEMORY_MODE": args.memory_mode,
+                "MEMORY_EMBEDDER": args.embedder,
+            }
+        )
+
+        ai_dir = os.path.join(workdir, "ai")
+        mailer_dir = os.path.join(workdir, "mailer")
+        stage_service(os.path.join(DF_DIR, "Dockerfile.ai"), ai_dir)
+        stage_service(os.path.join(DF_DIR, "Dockerfile.mailer"), mailer_dir)
+        with open(os.path.join(ai_dir, "openai.key"), "w", encoding="utf-8") as file:
+            file.write("sk-bench\norg-bench\n")
+
+        log = open(os.path.join(workdir, "services.log"), "w", encoding="utf-8")
+        output = sys.stdout if args.verbose else log
+        cwd = os.getcwd()
+        os.chdir(ai_dir)
+        try:
+            with contextlib.redirect_stdout(output):
+                ai_module = load_service(ai_dir, "ai_penpal")
+                mailer_module = load_service(mailer_dir, "penpal_mailer")
+                ai = ai_module.AiPenpal()
+                mailer = mailer_module.PenpalMailer()
+        finally:
+            os.chdir(cwd)
+        openai.api_base = fake_openai.api_base
+        mailer_module.build = gmail.build
+        if not args.throttle:
+            ai_module.time = NoSleep
+            mailer_module.time = NoSleep
+            ai.rate_limiter = ai_module.RateLimiter(0)
+
+        workload = generate_workload(
+            args.customers,
+            args.mails,
+            args.penpals,
+            args.body_words,
+            args.body_sigma,
+            args.quote_share,
+            args.skew,
+            args.arrival_rate,
+            args.seed,
+        )
+
+        counter.reset()
+        fake_openai.reset()
+        gmail.calls = 0
+        delivered = {}
+        next_mail = 0
+        start = time.time()
+
+        while time.time() - start < args.timeout:
+            elapsed = time.time() - start
+            while (
+                next_mail < len(workload) and workload[next_mail]["arrival"] <= elapsed
+            ):
+                mail = workload[next_mail]
+                gmail.deliver(
+                    f"token-{mail['penpal']}",
+                    f"{mail['customer']} <{mail['customer']}@example.org>",
+                    f"{mail['penpal']}+{mail['customer']}@example.com",
+                    mail["subject"],
+                    mail["body"],
+                )
+                delivered[mail["subject"]] = time.time()
+                next_mail += 1
+
+            with contextlib.redirect_stdout(output):
+                mailer.poll()
+                ai.poll()
+                mailer.poll()
+
+            if len(gmail.sent) >= len(workload):
+                break
+            if next_mail < len(workload) and len(gmail.sent) >= next_mail:
+                # Idle until the next mail arrives
+                time.sleep(max(0, workload[next_mail]["arrival"] - elapsed))
+
+        elapsed = time.time() - start
+        log.close()
+    finally:
+        fake_openai.stop()
+        if mongod is not None:
+            mongod.terminate()
+            mongod.wait()
+
+    latencies = [
+        sent_time - delivered[subject[len("Re: ") :]]
+        for sent_time, subject in gmail.sent
+        if subject[len("Re: ") :] in delivered
+    ]
+    completed = len(latencies)
+    per_mail = max(1, completed)
+    mongo_round_trips = sum(counter.counts.values())
+    result = {
+        "label": args.label,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "mails": len(workload),
+        "completed": completed,
+        "elapsed": elapsed,
+        "mails_per_min": completed / elapsed * 60,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "llm_calls_per_mail": fake_openai.stats["chat"] / per_mail,
+        "embedding_calls_per_mail": fake_openai.stats["embeddings"] / per_mail,
+        "llm_errors": fake_openai.stats["errors"],
+        "tokens_per_mail": fake_openai.stats["tokens"] / per_mail,
+        "mongo_round_trips_per_mail": mongo_round_trips / per_mail,
+        "mongo_commands": dict(counter.counts),
+        "gmail_calls_per_mail": gmail.calls / per_mail,
+    }
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(
+        RESULTS_DIR, f"{args.label}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results([result])
+    print(f"\nSaved to {path}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_results(results):
+    """Print the results side by side, with the change relative to the first one."""
+    header = f"{'':28}" + "".join(f"{r['label'][:18]:>20}" for r in results)
+    print(header)
+    print(
+        f"{'completed':28}"
+        + "".join(f"{str(r['completed']) + '/' + str(r['mails']):>20}" for r in results)
+    )
+    for key, higher_is_better in COMPARED:
+        base = results[0].get(key)
+        cells = []
+        for result in results:
+            value = result.get(key)
+            if value is None:
+                cells.append(f"{'-':>20}")
+                continue
+            cell = f"{value:.2f}"
+            if result is not results[0] and base:
+                change = (value - base) / base * 100
+                better = (change > 0) == higher_is_better
+                cell += f" ({change:+.0f}%{'' if change == 0 else ' +' if better else ' -'})"
+            cells.append(f"{cell:>20}")
+        print(f"{key:28}" + "".join(cells))
+
+
+def compare(args):
+    results = []
+    for pattern in args.results:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r", encoding="utf-8") as file:
+                results.append(json.load(file))
+    if not results:
+        sys.exit("No results found")
+    print_results(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bench = commands.add_parser("run", help="Run the benchmark and save the results")
+    bench.add_argument("--label", default="bench", help="Name of the result file")
+    bench.add_argument("--mongo-uri", help="Local disposable MongoDB to use")
+    bench.add_argument("--mongod", help="mongod binary for a throwaway database")
+    bench.add_argument("--penpals", type=int, default=1)
+    bench.add_argument("--customers", type=int, default=20, help="Customers per penpal")
+    bench.add_argument("--mails", type=int, default=100)
+    bench.add_argument("--body-words", type=int, default=150, help="Median body length")
+    bench.add_argument("--body-sigma", type=float, default=0.8)
+    bench.add_argument("--quote-share", type=float, default=0.3)
+    bench.add_argument("--skew", type=float, default=1.0, help="Zipf skew of customers")
+    bench.add_argument(
+        "--arrival-rate", type=float, default=0, help="Mails/s, 0 for all at once"
+    )
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--llm-latency", type=float, default=0.5)
+    bench.add_argument("--llm-jitter", type=float, default=0.2)
+    bench.add_argument("--llm-error-rate", type=float, default=0.0)
+    bench.add_argument("--reply-words", type=int, default=200)
+    bench.add_argument("--gmail-latency", type=float, default=0.05)
+    bench.add_argument("--reply-batch-size", type=int, default=10)
+    bench.add_argument("--memory-mode", default="retrieval")
+    bench.add_argument("--embedder", default="hashing")
+    bench.add_argument(
+        "--throttle",
+        action="store_true",
+        help="Keep the throttling sleeps of the services (slow)",
+    )
+    bench.add_argument("--timeout", type=float, default=3600)
+    bench.add_argument("--verbose", action="store_true", help="Show service output")
+    bench.set_defaults(func=run)
+
+    comparison = commands.add_parser("compare", help="Compare saved results")
+    comparison.add_argument("results", nargs="+", help="Result files (glob patterns)")
+    comparison.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    func = args.func
+    del args.func
+    func(args)
+
+
+if __name__ == "__main__":
+    main()
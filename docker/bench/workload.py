@@ -0,0 +1,64 @@
+import random
+
+WORDS = (
+    "hello friend weather garden holiday music book travel mountain river city "
+    "family dog cat dinner birthday school work weekend summer winter movie "
+    "football guitar painting coffee train beach forest museum concert recipe "
+    "neighbour bicycle library festival market island snow rain sunshine story"
+).split()
+
+
+def generate_workload(
+    customers,
+    mails,
+    penpals=1,
+    body_words=150,
+    body_sigma=0.8,
+    quote_share=0.3,
+    skew=1.0,
+    arrival_rate=0.0,
+    seed=1,
+):
+    """
+    Generate a synthetic inbound mail workload.
+
+    :param customers: Number of customers per penpal.
+    :param mails: Total number of mails.
+    :param penpals: Number of penpals.
+    :param body_words: Median body length in words (log-normally distributed).
+    :param body_sigma: Sigma of the log-normal body length distribution.
+    :param quote_share: Share of mails that end with quoted earlier messages.
+    :param skew: Zipf exponent of the mail counts of customers (0 for uniform).
+    :param arrival_rate: Mails per second (0 delivers every mail at once).
+    :param seed: Random seed.
+    :return: List of mail dictionaries with penpal, customer, subject, body and arrival
+        (seconds from the start of the run), in arrival order.
+    """
+    rng = random.Random(seed)
+    senders = [(p, c) for p in range(penpals) for c in range(customers)]
+    weights = [1 / (rank + 1) ** skew for rank in range(len(senders))]
+    rng.shuffle(weights)
+
+    workload = []
+    arrival = 0.0
+    for i in range(mails):
+        penpal, customer = rng.choices(senders, weights)[0]
+        # Stay below the 5000 word limit of the mailer
+        words = min(4900, max(1, int(rng.lognormvariate(0, body_sigma) * body_words)))
+        body = " ".join(rng.choice(WORDS) for _ in range(words))
+        if rng.random() < quote_share:
+            body += "\n\nOn Monday you wrote:\n" + "\n".join(
+                "> " + " ".join(rng.choices(WORDS, k=10)) for _ in range(6)
+            )
+        if arrival_rate > 0:
+            arrival += rng.expovariate(arrival_rate)
+        workload.append(
+            {
+                "penpal": f"benchpal{penpal}",
+                "customer": f"customer{customer}",
+                "subject": f"bench-{i:06d}",
+                "body": body,
+                "arrival": arrival,
+            }
+        )
+    return workload
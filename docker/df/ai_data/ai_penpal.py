@@ -1,23 +1,74 @@
 import os
-import random
 import time
 from functools import wraps
 
+import metrics
 import openai
+from mongo_client.bullet_memory import BulletMemory, OpenAIEmbedder
 from mongo_client.discussion_summary import DiscussionSummary
 from mongo_client.maildb import MailDB
+from mongo_client.persona_db import PersonaDB
+from mongo_client.rate_budget import RateBudget
+from polling_scheduler import PollingScheduler
+from profiling import CycleProfiler
+from rate_limiter import RateLimiter
+from reply_scheduler import ReplyScheduler
 
 
 class AiPenpal:
     def __init__(self):
         self.mail_db = MailDB()
+        self.mail_db.create_indexes()
         self.summaries_coll = DiscussionSummary()
+        # OpenAI embeddings go through the same rate limit and retries as the chats
+        embedder = None
+        if os.environ.get("MEMORY_EMBEDDER") == "openai":
+            embedder = OpenAIEmbedder(create=self.create_embeddings)
+        self.memory = BulletMemory(embedder)
+        self.personas = PersonaDB()
 
-        self.penpal_id = os.environ.get("PENPAL_ID")
-        self.penpal_name = os.environ.get("PENPAL_NAME")
+        # "retrieval" uses top-k bullets from earlier mails, "summary" the rewritten summary
+        self.memory_mode = os.environ.get("MEMORY_MODE", "retrieval")
+        self.memory_top_k = int(os.environ.get("MEMORY_TOP_K", 12))
+
+        # Mails from before multi-penpal support belong to the penpal of the environment
+        if os.environ.get("PENPAL_ID"):
+            self.mail_db.assign_penpal_id(os.environ.get("PENPAL_ID"))
 
         # ok to crash here
         self.polling_interval = int(os.environ.get("REPLY_POLLING_INTERVAL"))
+        self.scheduler = PollingScheduler(
+            "reply",
+            self.polling_interval,
+            int(os.environ.get("REPLY_POLLING_MIN_INTERVAL", 0)),
+            int(os.environ.get("REPLY_POLLING_MAX_INTERVAL", 0)),
+        )
+        # Mails replied per cycle, the rest are left for the next (immediate) cycle
+        self.batch_size = int(os.environ.get("REPLY_BATCH_SIZE", 10))
+        self.reply_scheduler = ReplyScheduler(
+            int(os.environ.get("REPLY_MAX_WAIT", 3600)),
+            int(os.environ.get("REPLY_AGING_INTERVAL", 600)),
+        )
+        # Budget of OpenAI calls per minute, shared with every process using the
+        # account (e.g. a summary rebuild)
+        self.calls_per_minute = int(os.environ.get("OPENAI_CALLS_PER_MINUTE", 40))
+        self.rate_budget = None
+        if self.calls_per_minute > 0:
+            self.rate_budget = RateBudget("openai", self.calls_per_minute)
+        self.rate_limiter = RateLimiter(0, self.rate_budget)
+        # Profiling runs are started with SIGUSR1 or PROFILE_ON_START
+        self.profiler = CycleProfiler(
+            "reply",
+            int(os.environ.get("PROFILE_CYCLES", 5)),
+            os.environ.get("PROFILE_DIR", "/tmp/profiles"),
+        )
+        if os.environ.get("PROFILE_ON_START") == "1":
+            self.profiler.request()
+        # Finished mails older than this (in days) are moved to the archive
+        self.archive_age = int(os.environ.get("MAIL_ARCHIVE_AGE", 30)) * 24 * 3600
+        # Archiving scans the mails collection, so it runs at most this often (seconds)
+        self.archive_interval = int(os.environ.get("MAIL_ARCHIVE_INTERVAL", 3600))
+        self.last_archive = 0.0
 
         with open("openai.key", "r", encoding="utf-8") as file:
             auth = file.read().split("\n")
@@ -58,8 +109,25 @@ class AiPenpal:
         ]
 
     def wait(self):
-        """Pause execution for the specified polling interval in order not to overwhelm external API services."""
-        time.sleep(self.polling_interval + random.random())
+        """Pause execution for the adaptive polling interval in order not to overwhelm external API services."""
+        self.scheduler.wait()
+
+    def update_queue_metrics(self):
+        """Export the number of mails in each state, 0 for drained states."""
+        for state, count in self.mail_db.count_emails_by_state().items():
+            metrics.QUEUE_DEPTH.labels(state).set(count)
+
+    def archive_old_mails(self):
+        """
+        Move finished mails to the compressed archive to keep the mails collection small.
+        Does nothing until archive_interval seconds have passed since the last run.
+        """
+        if time.time() - self.last_archive < self.archive_interval:
+            return
+        self.last_archive = time.time()
+        archived = self.mail_db.archive_old_emails(self.archive_age)
+        if archived > 0:
+            print(f"Archived {archived} mails")
 
     def generate_reply(self, mail_data, response):
         return {
@@ -68,6 +136,7 @@ class AiPenpal:
             "time_added": int(time.time()),
             "original_mail_id": mail_data["_id"],
             "customer_id": mail_data["customer_id"],
+            "penpal_id": mail_data["penpal_id"],
             "Subject": mail_data.get("Subject", "Penpal mail"),
             "From": mail_data["From"],
             "body": response["choices"][0]["message"]["content"],
@@ -79,26 +148,37 @@ class AiPenpal:
 
     def openai_rate_limit(func):
         """
-        Decorator for slowing down the API calls.
+        Decorator for slowing down the API calls to the budget of the rate limiter.
+        Records the latency, retries and backoff time of each stage.
         """
 
         @wraps(func)
-        def wrapper(*args, **kwargs):
+        def wrapper(self, *args, **kwargs):
             max_retries = 8
             base_delay = 3
 
             for i in range(max_retries):
                 try:
-                    time.sleep(1 + random.random())
-                    return func(*args, **kwargs)
+                    with self.profiler.stage("throttle"):
+                        self.rate_limiter.wait()
+                    with self.profiler.stage(func.__name__):
+                        with metrics.OPENAI_LATENCY.labels(func.__name__).time():
+                            return func(self, *args, **kwargs)
                 except (
                     openai.error.APIConnectionError,
                     openai.error.RateLimitError,
                 ) as e:
-                    if i < max_retries:
+                    if i < max_retries - 1:
                         print(e)  # make a bit of noise
                         print(f"Connection error: {i} (waiting)")
-                        time.sleep(base_delay * (2**i))  # Wait before retrying
+                        metrics.OPENAI_RETRIES.labels(func.__name__).inc()
+                        metrics.OPENAI_BACKOFF.labels(func.__name__).inc(
+                            base_delay * (2**i)
+                        )
+                        # Other threads hold off as well
+                        self.rate_limiter.pause(base_delay * (2**i))
+                        with self.profiler.stage("backoff"):
+                            time.sleep(base_delay * (2**i))  # Wait before retrying
                         print("Waiting done")
                         continue
                     else:
@@ -119,6 +199,7 @@ class AiPenpal:
         response = openai.ChatCompletion.create(
             model="gpt-3.5-turbo", messages=msgs, temperature=0.05
         )
+        metrics.record_openai_usage("generate_summary", response)
         return response["choices"][0]["message"]["content"]
 
     @openai_rate_limit
@@ -133,10 +214,11 @@ class AiPenpal:
         response = openai.ChatCompletion.create(
             model="gpt-3.5-turbo", messages=msgs, temperature=0.05
         )
+        metrics.record_openai_usage("generate_bullets", response)
         return response["choices"][0]["message"]["content"]
 
     @openai_rate_limit
-    def generate_new_response(self, email_text, summary):
+    def generate_new_response(self, email_text, summary, persona):
         msgs = []
         msgs.append(
             {
@@ -153,12 +235,20 @@ class AiPenpal:
         msgs.append(
             {
                 "role": "user",
-                "content": f"You are a penpal named {self.penpal_name}. Write an email back to your friend. Use the remarks provided earlier as a guide but do not repeat the topics listed there. \n\n{email_text}",
+                "content": f"You are a penpal named {persona['name']}. Write an email back to your friend. Use the remarks provided earlier as a guide but do not repeat the topics listed there. \n\n{email_text}",
             }
         )
-        return openai.ChatCompletion.create(
+        response = openai.ChatCompletion.create(
             model="gpt-3.5-turbo", messages=msgs, presence_penalty=1, temperature=0.8
         )
+        metrics.record_openai_usage("generate_new_response", response)
+        return response
+
+    @openai_rate_limit
+    def create_embeddings(self, **kwargs):
+        response = openai.Embedding.create(**kwargs)
+        metrics.record_openai_usage("create_embeddings", response)
+        return response
 
     def trim_email(self, text):
         """
@@ -203,57 +293,157 @@ class AiPenpal:
 
         return text
 
-    def check_new_messages(self):
+    def penpal_location(self, customer_id, persona):
+        """The penpal's location is picked deterministically from the time of the first mail."""
+        locations = persona.get("locations") or self.locations
+        mails = self.mail_db.find_emails_by_customer_id(customer_id, persona["_id"])
+        return locations[mails[0]["time_added"] % len(locations)]
+
+    def reply_with_summary(self, mail_data, email_text, persona):
+        """Reply using the single discussion summary that is rewritten on every exchange."""
+        customer_id = mail_data["customer_id"]
+        penpal_id = persona["_id"]
+
+        if self.mail_db.first_email(customer_id, penpal_id):
+            location = self.penpal_location(customer_id, persona)
+            summary = f"- {persona['name']} is currently living in: {location}."
+            self.summaries_coll.update_summary(customer_id, penpal_id, summary)
+        summary = self.summaries_coll.get_summary(customer_id, penpal_id)["summary"]
+
+        bullets = self.generate_bullets(email_text)
+        self.mail_db.add_mail_bullets(mail_data["_id"], bullets)
+
+        # old summary + new bullets
+        summary = f"{summary}\n{bullets}"
+        summary = self.generate_summary(summary)
+
+        self.summaries_coll.update_summary(customer_id, penpal_id, summary)
+        summary = self.summaries_coll.get_summary(customer_id, penpal_id)["summary"]
+
+        response = self.generate_new_response(email_text, summary, persona)
+        reply = self.generate_reply(mail_data, response)
+        print(reply["body"])
+
+        summary = f"{summary}\n{reply['bullets']}"
+        summary = self.generate_summary(summary)
+        self.summaries_coll.update_summary(customer_id, penpal_id, summary)
+        summary = self.summaries_coll.get_summary(customer_id, penpal_id)["summary"]
+        print(summary)
+
+        return reply
+
+    def reply_with_memory(self, mail_data, email_text, persona):
+        """Reply using a fixed number of relevant bullets retrieved from earlier mails."""
+        customer_id = mail_data["customer_id"]
+        penpal_id = persona["_id"]
+
+        if not self.memory.has_memory(customer_id, penpal_id):
+            location = self.penpal_location(customer_id, persona)
+            self.memory.add_bullets(
+                customer_id,
+                penpal_id,
+                f"{penpal_id}_location_{customer_id}",
+                f"- {persona['name']} is currently living in: {location}.",
+                pinned=True,
+            )
+            # Customers from before the retrieval memory keep their summary as memory
+            old_summary = self.summaries_coll.get_summary(customer_id, penpal_id)
+            if old_summary:
+                self.memory.add_bullets(
+                    customer_id,
+                    penpal_id,
+                    f"{penpal_id}_summary_{customer_id}",
+                    old_summary["summary"],
+                )
+            # As well as the bullets stored with their earlier emails
+            for mail in self.mail_db.find_emails_by_customer_id(customer_id, penpal_id):
+                if mail.get("bullets"):
+                    self.memory.add_bullets(
+                        customer_id, penpal_id, mail["_id"], mail["bullets"]
+                    )
+
+        bullets = self.generate_bullets(email_text)
+        self.mail_db.add_mail_bullets(mail_data["_id"], bullets)
+
+        remarks = self.memory.search(customer_id, penpal_id, bullets, self.memory_top_k)
+        self.memory.add_bullets(customer_id, penpal_id, mail_data["_id"], bullets)
+
+        response = self.generate_new_response(email_text, remarks, persona)
+        reply = self.generate_reply(mail_data, response)
+        print(reply["body"])
+
+        self.memory.add_bullets(customer_id, penpal_id, reply["_id"], reply["bullets"])
+
+        return reply
 
-        new_mails = self.mail_db.find_new_emails()
+    def check_new_messages(self):
+        """Reply to new mails and let the polling scheduler know how much work was found."""
+        self.scheduler.start_cycle()
+        with self.profiler.stage("queue"):
+            personas = {
+                persona["_id"]: persona for persona in self.personas.get_personas()
+            }
+            queue, truncated = self.mail_db.find_new_email_queue(
+                self.batch_size, personas.keys()
+            )
+            ordered = self.reply_scheduler.order(
+                queue, self.batch_size, self.mail_db.get_customer_priorities()
+            )
+            new_mails = self.mail_db.find_emails([mail["_id"] for mail in ordered])
+        latencies = []
 
         for mail_data in new_mails:
-            customer_id = mail_data["customer_id"]
+            try:
+                self.reply_to_mail(mail_data, personas[mail_data["penpal_id"]])
+            except (openai.error.APIConnectionError, openai.error.RateLimitError) as e:
+                # Still failing after the retries, the mail is retried on the next cycle
+                print(f"Cannot reply to mail {mail_data['_id']}: {e!r}")
+                continue
+            except Exception as e:
+                # A broken mail or persona must not stop the replies to the others
+                print(f"Cannot reply to mail {mail_data['_id']}: {e!r}")
+                self.mail_db.update_email(
+                    mail_data["_id"], {"state": "error", "error": repr(e)}
+                )
+                continue
+            wait = time.time() - mail_data["time_added"]
+            self.reply_scheduler.record_wait(mail_data, wait)
+            latencies.append(wait)
+
+        if len(latencies) > 0:
+            self.reply_scheduler.report()
+        backlog = truncated or len(queue) > len(ordered)
+        self.scheduler.record(len(latencies), backlog, latencies)
+
+    def reply_to_mail(self, mail_data, persona):
+        """Write the reply to a new mail, store it and mark the mail as replied."""
+        with self.profiler.stage("trim_email"):
             email_text = self.trim_email(mail_data["body"])
 
-            if self.mail_db.first_email(mail_data["customer_id"]):
-                location = self.locations[
-                    self.mail_db.find_emails_by_customer_id(customer_id)[0][
-                        "time_added"
-                    ]
-                    % len(self.locations)
-                ]
-                summary = f"- {self.penpal_name} is currently living in: {location}."
-                self.summaries_coll.update_summary(customer_id, self.penpal_id, summary)
-            summary = self.summaries_coll.get_summary(customer_id, self.penpal_id)[
-                "summary"
-            ]
-
-            bullets = self.generate_bullets(email_text)
-            self.mail_db.add_mail_bullets(mail_data["_id"], bullets)
-
-            # old summary + new bullets
-            summary = f"{summary}\n{bullets}"
-            summary = self.generate_summary(summary)
-
-            self.summaries_coll.update_summary(customer_id, self.penpal_id, summary)
-            summary = self.summaries_coll.get_summary(customer_id, self.penpal_id)[
-                "summary"
-            ]
-
-            response = self.generate_new_response(email_text, summary)
-            reply = self.generate_reply(mail_data, response)
-            print(reply["body"])
-
-            summary = f"{summary}\n{reply['bullets']}"
-            summary = self.generate_summary(summary)
-            self.summaries_coll.update_summary(customer_id, self.penpal_id, summary)
-            summary = self.summaries_coll.get_summary(customer_id, self.penpal_id)[
-                "summary"
-            ]
-            print(summary)
+        with self.profiler.stage("reply"):
+            if self.memory_mode == "summary":
+                reply = self.reply_with_summary(mail_data, email_text, persona)
+            else:
+                reply = self.reply_with_memory(mail_data, email_text, persona)
 
+        with self.profiler.stage("save"):
             self.mail_db.save_emails({"reply": reply})
             self.mail_db.update_email(reply["original_mail_id"], {"state": "replied"})
 
+    def poll(self):
+        """Run one polling cycle: reply to new mails, then archive and export the queue metrics."""
+        self.profiler.start_cycle()
+        self.check_new_messages()
+        with self.profiler.stage("archive_old_mails"):
+            self.archive_old_mails()
+        with self.profiler.stage("update_queue_metrics"):
+            self.update_queue_metrics()
+        self.profiler.end_cycle()
+
 
 if __name__ == "__main__":
+    metrics.start_metrics_server(int(os.environ.get("METRICS_PORT", 0)))
     penpal = AiPenpal()
     while True:
-        penpal.check_new_messages()
+        penpal.poll()
         penpal.wait()
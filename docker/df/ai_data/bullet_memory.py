@@ -0,0 +1,289 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import openai
+import pymongo
+from bson.binary import Binary
+from mongo_client.connection import mongo_client, mongo_db_uri
+
+
+class HashingEmbedder:
+    """
+    Local embedder that works offline. Words and word pairs are hashed into
+    a fixed number of buckets and weighted with sublinear term frequency.
+    The vectors are normalised so that a dot product equals the cosine similarity.
+    """
+
+    token_pattern = re.compile(r"[a-z0-9']+")
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _bucket(self, token):
+        # Python's hash() is salted per process, so use a stable hash instead
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "little") % self.dim
+
+    def embed(self, texts):
+        """
+        Embed a list of texts.
+
+        :param texts: List of strings.
+        :return: Float32 array of shape (len(texts), dim).
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = self.token_pattern.findall(text.lower())
+            tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            counts = {}
+            for token in tokens:
+                bucket = self._bucket(token)
+                counts[bucket] = counts.get(bucket, 0) + 1
+            for bucket, count in counts.items():
+                vectors[row, bucket] = 1 + math.log(count)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+class OpenAIEmbedder:
+    """Embedder using the OpenAI embeddings API."""
+
+    def __init__(self, model="text-embedding-ada-002", create=None):
+        """
+        :param model: Name of the embedding model.
+        :param create: Function making the API call, e.g. with rate limiting and retries
+            (default: openai.Embedding.create).
+        """
+        self.model = model
+        self.name = f"openai-{model}"
+        self.create = create or openai.Embedding.create
+
+    def embed(self, texts):
+        """
+        Embed a list of texts.
+
+        :param texts: List of strings.
+        :return: Float32 array of shape (len(texts), dim).
+        """
+        response = self.create(model=self.model, input=texts)
+        vectors = np.array(
+            [item["embedding"] for item in response["data"]], dtype=np.float32
+        )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+embedders = {"hashing": HashingEmbedder, "openai": OpenAIEmbedder}
+
+
+class VectorIndex:
+    """
+    In-memory vector index over the memory items of a single customer/penpal pair.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        if len(items) > 0:
+            self.matrix = np.stack(
+                [np.frombuffer(item["vector"], dtype=np.float32) for item in items]
+            )
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def search(self, query, k):
+        """
+        Find the k items most similar to the query vector.
+
+        :param query: Normalised query vector.
+        :param k: Number of returned items.
+        :return: List of memory items, most similar first.
+        """
+        if len(self.items) == 0 or k <= 0:
+            return []
+        scores = self.matrix @ query
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [self.items[i] for i in top]
+
+
+class BulletMemory:
+    """
+    A class to handle the retrieval memory in a MongoDB database.
+    Each bullet point of a mail is stored together with its embedding.
+    Instead of an ever-growing summary, the penpal gets a fixed number
+    of the most relevant bullets from earlier conversation. Pinned items
+    (such as the penpal's location) are always included.
+
+    The indexes of recently active customers are cached, and only the items
+    added since the last search are loaded from the database.
+    """
+
+    # Fields of the memory items needed for searching
+    item_fields = {"mail_id": 1, "text": 1, "vector": 1, "pinned": 1, "time_added": 1}
+
+    def __init__(self, embedder=None, cache_size=256):
+        """
+        :param embedder: Embedder of the bullet points (default: MEMORY_EMBEDDER).
+        :param cache_size: Number of customer/penpal indexes kept in memory.
+        """
+        self.mongo_db_uri = mongo_db_uri()
+        if embedder is None:
+            embedder = embedders[os.environ.get("MEMORY_EMBEDDER", "hashing")]()
+        self.embedder = embedder
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.index_created = False
+
+    def split_bullets(self, bullets):
+        """
+        Split generated bullet text into separate bullet points.
+
+        :param bullets: Bullet points as a single string.
+        :return: List of bullet point strings without the bullet characters.
+        """
+        lines = [line.strip().lstrip("-*•").strip() for line in bullets.split("\n")]
+        return [line for line in lines if line]
+
+    def add_bullets(self, customer_id, penpal_id, mail_id, bullets, pinned=False):
+        """
+        Index the bullet points of a mail. Indexing the same mail again replaces
+        the earlier bullet points.
+
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :param mail_id: Unique identifier of the mail the bullets belong to.
+        :param bullets: Bullet points as a single string.
+        :param pinned: Pinned items are returned by every search.
+        :return: Number of indexed bullet points.
+        """
+        lines = self.split_bullets(bullets)
+        if len(lines) == 0:
+            return 0
+        vectors = self.embedder.embed(lines)
+        now = int(time.time())
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        memory = db.bullet_memory
+        if not self.index_created:
+            memory.create_index(
+                [
+                    ("customer_id", pymongo.ASCENDING),
+                    ("penpal_id", pymongo.ASCENDING),
+                    ("embedder", pymongo.ASCENDING),
+                    ("time_added", pymongo.ASCENDING),
+                ]
+            )
+            self.index_created = True
+        memory.delete_many({"mail_id": mail_id, "embedder": self.embedder.name})
+        memory.insert_many(
+            [
+                {
+                    "_id": f"{mail_id}_{self.embedder.name}_{i}",
+                    "customer_id": customer_id,
+                    "penpal_id": penpal_id,
+                    "mail_id": mail_id,
+                    "embedder": self.embedder.name,
+                    "text": line,
+                    "vector": Binary(vector.tobytes()),
+                    "pinned": pinned,
+                    "time_added": now,
+                }
+                for i, (line, vector) in enumerate(zip(lines, vectors))
+            ]
+        )
+        return len(lines)
+
+    def get_index(self, customer_id, penpal_id):
+        """
+        Get the vector index of a customer/penpal pair. A cached index is
+        updated with the items added since it was loaded.
+
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :return: VectorIndex over the unpinned items and a list of the pinned items.
+        """
+        key = (customer_id, penpal_id)
+        with self.cache_lock:
+            cached = self.cache.pop(key, None)
+
+        query = {
+            "customer_id": customer_id,
+            "penpal_id": penpal_id,
+            "embedder": self.embedder.name,
+        }
+        if cached is not None:
+            # Items of the same second may have been loaded already, and indexing
+            # a mail again replaces its items, so the items of reloaded mails are replaced
+            query["time_added"] = {"$gte": cached["latest"]}
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        new_items = list(db.bullet_memory.find(query, self.item_fields))
+
+        if cached is None or len(new_items) > 0:
+            items = cached["items"] if cached is not None else []
+            reloaded = {item["mail_id"] for item in new_items}
+            items = [item for item in items if item["mail_id"] not in reloaded]
+            items += new_items
+            cached = {
+                "items": items,
+                "latest": max((item["time_added"] for item in items), default=0),
+                "index": VectorIndex(
+                    [item for item in items if not item.get("pinned")]
+                ),
+                "pinned": [item for item in items if item.get("pinned")],
+            }
+
+        with self.cache_lock:
+            self.cache[key] = cached
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return cached["index"], cached["pinned"]
+
+    def search(self, customer_id, penpal_id, query, k=12):
+        """
+        Retrieve the pinned items and the k bullet points most relevant to the query.
+
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :param query: Query text, e.g. the bullet points of the new mail.
+        :param k: Number of retrieved bullet points.
+        :return: Remarks as a bullet list string, in chronological order.
+        """
+        index, pinned = self.get_index(customer_id, penpal_id)
+        found = index.search(self.embedder.embed([query])[0], k)
+        found.sort(key=lambda item: (item["time_added"], item["_id"]))
+        return "\n".join(f"- {item['text']}" for item in pinned + found)
+
+    def has_memory(self, customer_id, penpal_id):
+        """
+        Check whether a customer/penpal pair already has indexed memory.
+
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :return: True if any memory items exist and otherwise False.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return (
+            db.bullet_memory.find_one(
+                {
+                    "customer_id": customer_id,
+                    "penpal_id": penpal_id,
+                    "embedder": self.embedder.name,
+                }
+            )
+            is not None
+        )
@@ -0,0 +1,38 @@
+import os
+import threading
+
+import pymongo
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def mongo_db_uri():
+    """
+    Construct the MongoDB connection URI from environment variables.
+    MAIL_DB_URI overrides the individual connection details.
+
+    :return: MongoDB connection URI.
+    """
+    if os.environ.get("MAIL_DB_URI"):
+        return os.environ.get("MAIL_DB_URI")
+    db_hostname = os.environ.get("MAIL_DB_HOSTNAME")
+    db_port = os.environ.get("MAIL_DB_PORT")
+    db_name = os.environ.get("MAIL_DB_NAME")
+    db_user = os.environ.get("MAIL_DB_USER")
+    db_password = os.environ.get("MAIL_DB_PASSWORD")
+    return f"mongodb://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}"
+
+
+def mongo_client(uri):
+    """
+    Get the MongoClient for the given URI. A single client (and its connection pool)
+    is shared by every database class and persona of the process.
+
+    :param uri: MongoDB connection URI.
+    :return: Shared MongoClient object.
+    """
+    with _clients_lock:
+        if uri not in _clients:
+            _clients[uri] = pymongo.MongoClient(uri)
+        return _clients[uri]
@@ -1,7 +1,6 @@
-import os
 import time
 
-import pymongo
+from mongo_client.connection import mongo_client, mongo_db_uri
 
 
 class DiscussionSummary:
@@ -14,14 +13,7 @@ class DiscussionSummary:
     """
 
     def __init__(self):
-        db_hostname = os.environ.get("MAIL_DB_HOSTNAME")
-        db_port = os.environ.get("MAIL_DB_PORT")
-        db_name = os.environ.get("MAIL_DB_NAME")
-        db_user = os.environ.get("MAIL_DB_USER")
-        db_password = os.environ.get("MAIL_DB_PASSWORD")
-        self.mongo_db_uri = (
-            f"mongodb://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}"
-        )
+        self.mongo_db_uri = mongo_db_uri()
 
     def _add_summary(self, customer_id, penpal_id, summary):
         """
@@ -32,20 +24,20 @@ class DiscussionSummary:
         :param summary: The summary text.
         :return: The result of the insertion operation.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            summaries = db.discussion_summaries
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        summaries = db.discussion_summaries
 
-            temp_sum = {
-                "customer_id": customer_id,
-                "penpal_id": penpal_id,
-                "summary": summary,
-                "time_added": int(time.time()),
-                "time_modified": int(time.time()),
-                "iteration": 1,
-            }
+        temp_sum = {
+            "customer_id": customer_id,
+            "penpal_id": penpal_id,
+            "summary": summary,
+            "time_added": int(time.time()),
+            "time_modified": int(time.time()),
+            "iteration": 1,
+        }
 
-            return summaries.insert_one(temp_sum)
+        return summaries.insert_one(temp_sum)
 
     def update_summary(self, customer_id, penpal_id, summary):
         """
@@ -56,18 +48,18 @@ class DiscussionSummary:
         :param summary: The updated summary text.
         :return: The result of the update or insertion operation.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            if self.summary_exists(customer_id, penpal_id):
-                return db.discussion_summaries.update_one(
-                    {"customer_id": customer_id, "penpal_id": penpal_id},
-                    {
-                        "$set": {"summary": summary, "time_modified": int(time.time())},
-                        "$inc": {"iteration": 1},
-                    },
-                )
-            else:
-                return self._add_summary(customer_id, penpal_id, summary)
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        if self.summary_exists(customer_id, penpal_id):
+            return db.discussion_summaries.update_one(
+                {"customer_id": customer_id, "penpal_id": penpal_id},
+                {
+                    "$set": {"summary": summary, "time_modified": int(time.time())},
+                    "$inc": {"iteration": 1},
+                },
+            )
+        else:
+            return self._add_summary(customer_id, penpal_id, summary)
 
     def get_summary(self, customer_id, penpal_id):
         """
@@ -77,11 +69,11 @@ class DiscussionSummary:
         :param penpal_id: The ID of the penpal.
         :return: The summary document, or None if not found.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            return db.discussion_summaries.find_one(
-                {"customer_id": customer_id, "penpal_id": penpal_id}
-            )
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.discussion_summaries.find_one(
+            {"customer_id": customer_id, "penpal_id": penpal_id}
+        )
 
     def summary_exists(self, customer_id, penpal_id):
         """
@@ -91,11 +83,11 @@ class DiscussionSummary:
         :param penpal_id: The ID of the penpal.
         :return: True if a customer/penpal pair already has a summary and otherwise false.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            return (
-                db.discussion_summaries.find_one(
-                    {"customer_id": customer_id, "penpal_id": penpal_id}
-                )
-                != None
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return (
+            db.discussion_summaries.find_one(
+                {"customer_id": customer_id, "penpal_id": penpal_id}
             )
+            != None
+        )
@@ -0,0 +1,194 @@
+import json
+import time
+import zlib
+
+import pymongo
+from bson.binary import Binary
+from mongo_client.connection import mongo_client, mongo_db_uri
+
+
+class MailArchive:
+    """
+    A class to handle the cold storage of old emails in a MongoDB database.
+    Emails that are no longer part of the processing pipeline are moved from
+    the hot mails collection into an archive collection. Large fields
+    (body and the raw OpenAI response) are stored compressed so that the
+    archive stays compact. Archived emails are returned in their original
+    shape by the read methods.
+    """
+
+    # Only emails in these states are finished with and can be archived
+    archived_states = ["replied", "sent", "error"]
+
+    # These fields are compressed into a single blob in the archive
+    compressed_fields = ["body", "raw_response"]
+
+    def __init__(self):
+        self.mongo_db_uri = mongo_db_uri()
+
+    def _compress(self, mail):
+        """
+        Compress the large fields of an email for storage in the archive.
+
+        :param mail: Email record from the mails collection.
+        :return: Archive record with the large fields compressed.
+        """
+        archived = {k: v for k, v in mail.items() if k not in self.compressed_fields}
+        payload = {k: mail[k] for k in self.compressed_fields if k in mail}
+        archived["compressed"] = Binary(
+            zlib.compress(json.dumps(payload, default=str).encode("utf-8"), 9)
+        )
+        archived["time_archived"] = int(time.time())
+        return archived
+
+    def _decompress(self, archived):
+        """
+        Restore an archived email into its original shape.
+
+        :param archived: Archive record.
+        :return: Email record with the large fields decompressed.
+        """
+        mail = {
+            k: v
+            for k, v in archived.items()
+            if k not in ("compressed", "time_archived")
+        }
+        if "compressed" in archived:
+            mail.update(
+                json.loads(zlib.decompress(archived["compressed"]).decode("utf-8"))
+            )
+        return mail
+
+    def create_indexes(self):
+        """Create the indexes of the archive collection."""
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        db.mails_archive.create_index(
+            [("customer_id", pymongo.ASCENDING), ("time_added", pymongo.ASCENDING)]
+        )
+
+    def archive_emails(self, max_age, batch_size=500):
+        """
+        Move finished emails older than max_age seconds into the archive.
+        Emails are first written to the archive and only then removed from
+        the mails collection, so an interrupted run never loses data.
+
+        :param max_age: Minimum age of the archived emails in seconds.
+        :param batch_size: Number of emails moved per round trip.
+        :return: Number of archived emails.
+        """
+        cutoff = int(time.time()) - max_age
+        archived = 0
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        while True:
+            mails = list(
+                db.mails.find(
+                    {
+                        "state": {"$in": self.archived_states},
+                        "time_added": {"$lt": cutoff},
+                    }
+                ).limit(batch_size)
+            )
+            if len(mails) == 0:
+                return archived
+
+            db.mails_archive.bulk_write(
+                [
+                    pymongo.ReplaceOne(
+                        {"_id": mail["_id"]}, self._compress(mail), upsert=True
+                    )
+                    for mail in mails
+                ],
+                ordered=False,
+            )
+            db.mails.delete_many({"_id": {"$in": [mail["_id"] for mail in mails]}})
+            archived += len(mails)
+
+    def find_emails_by_customer_id(self, customer_id, penpal_id=None):
+        """
+        Find archived emails by customer_id.
+
+        :param customer_id: Unique identifier of the customer.
+        :param penpal_id: Only find emails of this penpal (None for all penpals).
+        :return: List of archived email records, sorted by time_added in ascending order.
+        """
+        query = {"customer_id": customer_id}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return [
+            self._decompress(mail)
+            for mail in db.mails_archive.find(query).sort(
+                "time_added", pymongo.ASCENDING
+            )
+        ]
+
+    def find_customers(self, penpal_id=None):
+        """
+        Find the customers with archived emails.
+
+        :param penpal_id: Only find customers of this penpal (None for all penpals).
+        :return: Set of (penpal_id, customer_id) pairs.
+        """
+        query = {"customer_id": {"$ne": None}, "penpal_id": {"$ne": None}}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return {
+            (group["_id"]["penpal_id"], group["_id"]["customer_id"])
+            for group in db.mails_archive.aggregate(
+                [
+                    {"$match": query},
+                    {
+                        "$group": {
+                            "_id": {
+                                "penpal_id": "$penpal_id",
+                                "customer_id": "$customer_id",
+                            }
+                        }
+                    },
+                ]
+            )
+        }
+
+    def count_emails(self, customer_id, penpal_id=None):
+        """
+        Count archived emails of a customer.
+
+        :param customer_id: Unique identifier of the customer.
+        :param penpal_id: Only count emails of this penpal (None for all penpals).
+        :return: Number of archived emails of the given customer_id.
+        """
+        query = {"customer_id": customer_id}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.mails_archive.count_documents(query)
+
+    def find_email(self, mid):
+        """
+        Find an archived email by its unique ID.
+
+        :param mid: Unique identifier of the email.
+        :return: Email record associated with the given mid, or None if not found.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mail = db.mails_archive.find_one({"_id": mid})
+        return self._decompress(mail) if mail else None
+
+    def assign_penpal_id(self, penpal_id):
+        """
+        Assign archived emails stored before multi-penpal support to the given penpal.
+
+        :param penpal_id: The ID of the penpal the emails belong to.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        db.mails_archive.update_many(
+            {"penpal_id": {"$exists": False}}, {"$set": {"penpal_id": penpal_id}}
+        )
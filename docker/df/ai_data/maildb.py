@@ -1,6 +1,6 @@
-import os
-
 import pymongo
+from mongo_client.connection import mongo_client, mongo_db_uri
+from mongo_client.mail_archive import MailArchive
 
 
 class MailDB:
@@ -10,19 +10,16 @@ class MailDB:
     Use environment variables to define the critical parameters for operation.
     """
 
+    # States of an email, from arrival to sending (or failure)
+    states = ["new", "pending", "replied", "sent", "error"]
+
     def __init__(self):
         """
         Initialise MailDB object by fetching database connection details from environment variables
         and constructing the MongoDB connection URI.
         """
-        db_hostname = os.environ.get("MAIL_DB_HOSTNAME")
-        db_port = os.environ.get("MAIL_DB_PORT")
-        db_name = os.environ.get("MAIL_DB_NAME")
-        db_user = os.environ.get("MAIL_DB_USER")
-        db_password = os.environ.get("MAIL_DB_PASSWORD")
-        self.mongo_db_uri = (
-            f"mongodb://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}"
-        )
+        self.mongo_db_uri = mongo_db_uri()
+        self.archive = MailArchive()
 
     def save_emails(self, mails):
         """
@@ -32,42 +29,154 @@ class MailDB:
         :return: List of ObjectIds of the inserted emails.
         """
         ids = []
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+
+        for mid in mails:
+            new_email = mails[mid]
+            ids.append(mails_db.insert_one(new_email).inserted_id)
+        return ids
+
+    def find_new_email_queue(self, per_customer=0, penpal_ids=None):
+        """
+        Find the oldest new emails of every customer without their content.
+
+        :param per_customer: Maximum number of emails per customer (0 for no limit).
+        :param penpal_ids: Only find emails sent to these penpals (None for all penpals).
+        :return: List of email records with _id, customer_id, penpal_id and time_added,
+            and True if some customers had more emails than per_customer.
+        """
+        query = {"state": "new"}
+        if penpal_ids is not None:
+            query["penpal_id"] = {"$in": list(penpal_ids)}
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        groups = mails_db.aggregate(
+            [
+                {"$match": query},
+                {"$sort": {"time_added": pymongo.ASCENDING}},
+                {
+                    "$group": {
+                        "_id": {
+                            "customer_id": "$customer_id",
+                            "penpal_id": "$penpal_id",
+                        },
+                        "mails": {
+                            "$push": {
+                                "_id": "$_id",
+                                "customer_id": "$customer_id",
+                                "penpal_id": "$penpal_id",
+                                "time_added": "$time_added",
+                            }
+                        },
+                    }
+                },
+            ]
+        )
+        queue = []
+        truncated = False
+        for group in groups:
+            mails = group["mails"]
+            if per_customer > 0 and len(mails) > per_customer:
+                mails = mails[:per_customer]
+                truncated = True
+            queue += mails
+        return queue, truncated
 
-            for mid in mails:
-                new_email = mails[mid]
-                ids.append(mails_db.insert_one(new_email).inserted_id)
-            return ids
+    def find_emails(self, mids):
+        """
+        Find emails by their unique IDs.
 
-    def find_new_emails(self):
+        :param mids: List of unique email identifiers.
+        :return: List of email records in the order of mids.
         """
-        Find new emails in the database.
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails = {mail["_id"]: mail for mail in mails_db.find({"_id": {"$in": mids}})}
+        return [mails[mid] for mid in mids if mid in mails]
 
-        :return: List of new email records.
+    def get_customer_priorities(self):
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [mail for mail in mails_db.find({"state": "new"})]
+        Get the priority tiers and round-robin weights of customers.
+        Customers without a record have the default tier and weight 1.
+        Records without penpal_id or customer_id, or with a tier or weight that
+        is not a number, are skipped.
 
-    def find_emails_by_customer_id(self, customer_id):
+        :return: Dictionary of {(penpal_id, customer_id): {"tier": .., "weight": ..}}.
         """
-        Find emails by customer_id in the database.
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        priorities = {}
+        for doc in db.customer_priorities.find():
+            valid = "penpal_id" in doc and "customer_id" in doc
+            for field in ("tier", "weight"):
+                value = doc.get(field)
+                if value is not None and (
+                    isinstance(value, bool) or not isinstance(value, (int, float))
+                ):
+                    valid = False
+            if not valid:
+                print(f"Skipping invalid customer priority: {doc}")
+                continue
+            priorities[(doc["penpal_id"], doc["customer_id"])] = doc
+        return priorities
+
+    def find_emails_by_customer_id(self, customer_id, penpal_id=None):
+        """
+        Find emails by customer_id in the database. Archived emails are included.
 
         :param customer_id: Unique identifier of the customer.
+        :param penpal_id: Only find emails of this penpal (None for all penpals).
         :return: List of email records associated with the given customer_id, sorted by time_added in ascending order.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [
-                mail
-                for mail in mails_db.find({"customer_id": customer_id}).sort(
-                    "time_added", pymongo.ASCENDING
-                )
-            ]
+        query = {"customer_id": customer_id}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails = [
+            mail for mail in mails_db.find(query).sort("time_added", pymongo.ASCENDING)
+        ]
+        archived = self.archive.find_emails_by_customer_id(customer_id, penpal_id)
+        if len(archived) == 0:
+            return mails
+        return sorted(archived + mails, key=lambda mail: mail["time_added"])
+
+    def find_customers(self, penpal_id=None):
+        """
+        Find the customers with emails in the database. Archived emails are included.
+
+        :param penpal_id: Only find customers of this penpal (None for all penpals).
+        :return: List of (penpal_id, customer_id) pairs, sorted.
+        """
+        query = {"customer_id": {"$ne": None}, "penpal_id": {"$ne": None}}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        customers = {
+            (group["_id"]["penpal_id"], group["_id"]["customer_id"])
+            for group in mails_db.aggregate(
+                [
+                    {"$match": query},
+                    {
+                        "$group": {
+                            "_id": {
+                                "penpal_id": "$penpal_id",
+                                "customer_id": "$customer_id",
+                            }
+                        }
+                    },
+                ]
+            )
+        }
+        customers |= self.archive.find_customers(penpal_id)
+        return sorted(customers)
 
     def outgoing_email(self):
         """
@@ -75,37 +184,45 @@ class MailDB:
 
         :return: List of pending email records.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [mail for mail in mails_db.find({"state": "pending"})]
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return [mail for mail in mails_db.find({"state": "pending"})]
 
-    def first_email(self, customer_id):
+    def first_email(self, customer_id, penpal_id=None):
         """
         Check if it's the first email for a given customer_id.
         Initial exchange if only one email found from the DB.
 
         :param customer_id: Unique identifier of the customer.
+        :param penpal_id: Only count emails of this penpal (None for all penpals).
         :return: True if it's the first email for the given customer_id, otherwise False.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return (
-                len([mail for mail in mails_db.find({"customer_id": customer_id})]) < 2
-            )
+        query = {"customer_id": customer_id}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        count = mails_db.count_documents(query, limit=2)
+        if count >= 2:
+            return False
+        return count + self.archive.count_emails(customer_id, penpal_id) < 2
 
     def find_email(self, mid):
         """
-        Find an email by its unique ID.
+        Find an email by its unique ID. Falls back to the archive.
 
         :param mid: Unique identifier of the email.
         :return: Email record associated with the given mid, or None if not found.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return mails_db.find_one({"_id": mid})
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mail = mails_db.find_one({"_id": mid})
+        if mail is None:
+            return self.archive.find_email(mid)
+        return mail
 
     def add_mail_bullets(self, m_id, bullets):
         """
@@ -123,7 +240,55 @@ class MailDB:
         :param m_id: Unique identifier of the email.
         :param new_data: Dictionary containing the new data to be updated in the email record.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            mails_db.update_one({"_id": m_id}, {"$set": new_data})
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails_db.update_one({"_id": m_id}, {"$set": new_data})
+
+    def count_emails_by_state(self):
+        """
+        Count the emails in each state with the state index.
+
+        :return: Dictionary of {state: number of emails}, including empty states.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return {
+            state: mails_db.count_documents({"state": state}) for state in self.states
+        }
+
+    def create_indexes(self):
+        """Create the indexes of the mails and the archive collections."""
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails_db.create_index("state")
+        mails_db.create_index(
+            [("customer_id", pymongo.ASCENDING), ("time_added", pymongo.ASCENDING)]
+        )
+        self.archive.create_indexes()
+
+    def archive_old_emails(self, max_age):
+        """
+        Move finished emails older than max_age seconds into the archive
+        in order to keep the mails collection small.
+
+        :param max_age: Minimum age of the archived emails in seconds.
+        :return: Number of archived emails.
+        """
+        return self.archive.archive_emails(max_age)
+
+    def assign_penpal_id(self, penpal_id):
+        """
+        Assign emails stored before multi-penpal support to the given penpal.
+
+        :param penpal_id: The ID of the penpal the emails belong to.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails_db.update_many(
+            {"penpal_id": {"$exists": False}}, {"$set": {"penpal_id": penpal_id}}
+        )
+        self.archive.assign_penpal_id(penpal_id)
@@ -0,0 +1,171 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Returned by stage() while profiling is off
+_OFF = nullcontext()
+
+
+class CycleProfiler:
+    """
+    On-demand profiling of a polling loop. A profiling run is started with
+    SIGUSR1 (or at startup) and lasts for a number of polling cycles. During
+    a run, a background thread samples the stacks of all threads, and the
+    wall-clock time of the stages of every cycle is logged. At the end of the
+    run, the samples are written as folded stacks, which can be opened with
+    speedscope or flamegraph.pl.
+
+    While no run is active, stage() returns a shared no-op context manager
+    and nothing is sampled.
+    """
+
+    def __init__(self, name, cycles=5, directory="/tmp/profiles", interval=0.005):
+        """
+        :param name: Name of the polling loop, used in the log output and file names.
+        :param cycles: Number of cycles profiled per run.
+        :param directory: Directory of the profile files.
+        :param interval: Sampling interval in seconds.
+        """
+        self.name = name
+        self.cycles = cycles
+        self.directory = directory
+        self.interval = interval
+        self.pending = False
+        self.remaining = 0
+        self.active = False
+        self.samples = Counter()
+        self.stages = Counter()
+        self.run_stages = Counter()
+        self.stack = []
+        self.cycle_start = 0.0
+        self.run_start = 0.0
+        self._stop = threading.Event()
+        self._sampler = None
+
+        # Signal handlers can only be installed from the main thread
+        if (
+            hasattr(signal, "SIGUSR1")
+            and threading.current_thread() is threading.main_thread()
+        ):
+            signal.signal(signal.SIGUSR1, self.request)
+
+    def request(self, signum=None, frame=None):
+        """Profile the next cycles. Also used as the SIGUSR1 handler."""
+        self.pending = True
+
+    def start_cycle(self):
+        """Mark the start of a polling cycle, starting a requested profiling run."""
+        if self.pending:
+            self.pending = False
+            self.remaining = self.cycles
+            if not self.active:
+                self._start_run()
+        if self.active:
+            self.stages.clear()
+            self.stack = []
+            self.cycle_start = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Context manager timing a stage of the current cycle. Nested stages
+        are recorded as parent/child.
+        """
+        if not self.active:
+            return _OFF
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        self.stack.append(name)
+        path = "/".join(self.stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[path] += time.perf_counter() - start
+            self.stack.pop()
+
+    def end_cycle(self):
+        """Log the stage breakdown of a profiled cycle, ending the run after the last one."""
+        if not self.active:
+            return
+        duration = time.perf_counter() - self.cycle_start
+        self.run_stages.update(self.stages)
+        self.run_stages["cycle"] += duration
+        print(f"{self.name} profile: {self.breakdown(self.stages, duration)}")
+
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self._end_run()
+
+    def breakdown(self, stages, duration):
+        """
+        Format the time spent in each stage.
+
+        :param stages: Dictionary of {stage path: seconds}.
+        :param duration: Wall-clock duration of the cycle in seconds.
+        :return: Breakdown with the top-level time outside of any stage as "other".
+        """
+        other = duration - sum(t for path, t in stages.items() if "/" not in path)
+        parts = [f"cycle {duration:.3f}s"]
+        for path, seconds in sorted(stages.items()) + [("other", other)]:
+            share = 100 * seconds / duration if duration > 0 else 0
+            parts.append(f"{path} {seconds:.3f}s ({share:.0f}%)")
+        return ", ".join(parts)
+
+    def _start_run(self):
+        print(f"{self.name} profile: profiling {self.cycles} cycles")
+        self.active = True
+        self.samples = Counter()
+        self.run_stages = Counter()
+        self.run_start = time.time()
+        self._stop.clear()
+        self._sampler = threading.Thread(
+            target=self._sample, name=f"profiler-{self.name}", daemon=True
+        )
+        self._sampler.start()
+
+    def _end_run(self):
+        self.active = False
+        self._stop.set()
+        self._sampler.join()
+
+        cycle_time = self.run_stages.pop("cycle")
+        print(
+            f"{self.name} profile: {self.cycles} cycles: "
+            f"{self.breakdown(self.run_stages, cycle_time)}"
+        )
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.run_start))
+        path = os.path.join(self.directory, f"{self.name}-{stamp}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                for stack, count in self.samples.most_common():
+                    file.write(f"{stack} {count}\n")
+            print(
+                f"{self.name} profile: {sum(self.samples.values())} samples in {path}"
+            )
+        except OSError as e:
+            print(f"Cannot write the profile: {e}")
+
+    def _sample(self):
+        """Sample the stacks of all other threads until the run ends."""
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self.samples[";".join(stack)] += 1
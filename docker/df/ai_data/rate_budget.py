@@ -0,0 +1,62 @@
+import pymongo
+from mongo_client.connection import mongo_client, mongo_db_uri
+
+
+class RateBudget:
+    """
+    A class to handle a budget of API calls shared by several processes in a
+    MongoDB database. The budget is a timeline of call slots: every call
+    reserves the next free slot, and the slots are 60 / calls_per_minute
+    seconds apart. Processes drawing from the same budget therefore stay
+    within calls_per_minute together.
+    """
+
+    def __init__(self, name, calls_per_minute):
+        """
+        :param name: Name of the budget, shared by the processes using it.
+        :param calls_per_minute: Calls per minute allowed by the budget.
+        """
+        self.mongo_db_uri = mongo_db_uri()
+        self.name = name
+        self.interval = 60 / calls_per_minute
+
+    def reserve(self, earliest):
+        """
+        Reserve the first free call slot that is not before earliest.
+
+        :param earliest: Unix time before which the call cannot be made.
+        :return: Unix time of the reserved slot.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        budgets = db.rate_budgets
+        while True:
+            budget = budgets.find_one({"_id": self.name})
+            if budget is None:
+                try:
+                    budgets.insert_one(
+                        {"_id": self.name, "next_call": earliest + self.interval}
+                    )
+                    return earliest
+                except pymongo.errors.DuplicateKeyError:
+                    continue
+            slot = max(earliest, budget["next_call"])
+            # Only succeeds if no other process has reserved the slot meanwhile
+            result = budgets.update_one(
+                {"_id": self.name, "next_call": budget["next_call"]},
+                {"$set": {"next_call": slot + self.interval}},
+            )
+            if result.matched_count == 1:
+                return slot
+
+    def hold(self, until):
+        """
+        Allow no calls from any process before the given time.
+
+        :param until: Unix time of the next allowed call.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        db.rate_budgets.update_one(
+            {"_id": self.name}, {"$max": {"next_call": until}}, upsert=True
+        )
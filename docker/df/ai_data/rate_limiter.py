@@ -0,0 +1,53 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Spaces out API calls evenly to stay within a budget of calls per minute.
+    The limiter is thread-safe, so the workers of a process share one budget,
+    and a rate limit error seen by one worker pauses all of them. With a
+    RateBudget, every call also takes a slot of a budget shared with other
+    processes, and a pause holds off those processes as well.
+    """
+
+    def __init__(self, calls_per_minute=40, budget=None):
+        """
+        :param calls_per_minute: Calls per minute of this process (0 for no own limit).
+        :param budget: RateBudget shared with other processes (None for no shared budget).
+        """
+        self.interval = 60 / calls_per_minute if calls_per_minute > 0 else 0
+        self.budget = budget
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next call fits in the budget.
+
+        :return: Seconds waited.
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_call)
+            self.next_call = slot + self.interval
+        if self.budget is not None:
+            slot = self.budget.reserve(slot)
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """
+        Hold off every caller for a while, e.g. after a rate limit error.
+
+        :param seconds: No calls are allowed for this many seconds.
+        """
+        until = time.time() + seconds
+        if self.budget is not None:
+            self.budget.hold(until)
+        # An unlimited limiter never holds off, e.g. in the benchmark
+        if self.interval > 0:
+            with self.lock:
+                self.next_call = max(self.next_call, until)
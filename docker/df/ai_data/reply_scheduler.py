@@ -0,0 +1,147 @@
+import time
+from collections import deque
+
+import metrics
+
+
+class ReplyScheduler:
+    """
+    Orders the reply backlog so that a single chatty customer cannot delay
+    everyone else. Mails are served in priority tiers (0 is the highest).
+    Within a tier, penpals and then customers take turns in weighted
+    round-robin order (a customer with weight 2 gets two replies for every
+    reply of a customer with weight 1).
+
+    Waiting mails age: every aging_interval seconds of waiting raises a mail
+    by one tier, and a mail that has waited longer than max_wait is served
+    before everything else, oldest first. This bounds the worst-case wait to
+    max_wait plus the time needed to reply to the mails that are overdue as well.
+    """
+
+    def __init__(
+        self, max_wait=3600, aging_interval=600, default_tier=1, min_weight=0.1
+    ):
+        """
+        :param max_wait: Mails waiting longer than this (seconds) are served first.
+        :param aging_interval: Waiting this many seconds raises a mail by one tier.
+        :param default_tier: Tier of customers without a priority.
+        :param min_weight: Smaller (e.g. zero or negative) weights are raised to this.
+        """
+        self.max_wait = max_wait
+        self.aging_interval = aging_interval
+        self.default_tier = default_tier
+        self.min_weight = min_weight
+        # Virtual time of the weighted round-robin, per penpal and per customer
+        self.penpal_time = {}
+        self.customer_time = {}
+        # Recent queue wait times in seconds per (penpal_id, customer_id)
+        self.waits = {}
+
+    def _tier(self, mail, wait, priorities):
+        """Effective tier of a mail after aging, -1 for overdue mails."""
+        if wait >= self.max_wait:
+            return -1
+        key = (mail.get("penpal_id"), mail["customer_id"])
+        tier = priorities.get(key, {}).get("tier")
+        if tier is None:
+            tier = self.default_tier
+        return max(0, tier - int(wait // self.aging_interval))
+
+    def order(self, mails, limit=0, priorities=None, now=None):
+        """
+        Order mails for replying.
+
+        :param mails: Waiting mails with customer_id, penpal_id and time_added.
+        :param limit: Maximum number of returned mails (0 for no limit).
+        :param priorities: Dictionary of {(penpal_id, customer_id): {"tier": .., "weight": ..}}.
+        :param now: Current time, defaults to time.time().
+        :return: List of mails in the order they should be replied to.
+        """
+        priorities = priorities or {}
+        now = now or time.time()
+        limit = limit or len(mails)
+
+        queues = {}
+        for mail in sorted(mails, key=lambda mail: mail["time_added"]):
+            key = (mail.get("penpal_id"), mail["customer_id"])
+            queues.setdefault(key, deque()).append(mail)
+
+        # Customers without waiting mails are forgotten, and newcomers start from
+        # the virtual time of the waiting customers instead of catching up
+        penpals = {penpal_id for penpal_id, _ in queues}
+        self.penpal_time = {k: v for k, v in self.penpal_time.items() if k in penpals}
+        self.customer_time = {
+            k: v for k, v in self.customer_time.items() if k in queues
+        }
+        base_penpal = min(self.penpal_time.values(), default=0)
+        base_customer = min(self.customer_time.values(), default=0)
+        for penpal_id, customer_id in queues:
+            self.penpal_time.setdefault(penpal_id, base_penpal)
+            self.customer_time.setdefault((penpal_id, customer_id), base_customer)
+
+        def rank(key):
+            mail = queues[key][0]
+            wait = now - mail["time_added"]
+            tier = self._tier(mail, wait, priorities)
+            return (
+                tier,
+                -wait if tier < 0 else 0,
+                self.penpal_time[key[0]],
+                self.customer_time[key],
+                mail["time_added"],
+            )
+
+        ordered = []
+        while queues and len(ordered) < limit:
+            key = min(queues, key=rank)
+            ordered.append(queues[key].popleft())
+            if not queues[key]:
+                del queues[key]
+
+            weight = priorities.get(key, {}).get("weight")
+            if weight is None:
+                weight = 1
+            weight = max(weight, self.min_weight)
+            self.penpal_time[key[0]] += 1
+            self.customer_time[key] += 1 / weight
+
+        return ordered
+
+    def record_wait(self, mail, wait):
+        """
+        Record the queue wait time of a replied mail.
+
+        :param mail: The replied mail.
+        :param wait: Seconds from the arrival of the mail to the reply.
+        """
+        key = (mail.get("penpal_id"), mail["customer_id"])
+        self.waits.setdefault(key, deque(maxlen=200)).append(wait)
+        metrics.REPLY_WAIT.labels(key[0]).observe(wait)
+
+    def wait_stats(self):
+        """
+        Queue wait statistics of the recently replied mails.
+
+        :return: Dictionary of {(penpal_id, customer_id): {"count", "p50", "p99", "max"}}.
+        """
+        stats = {}
+        for key, waits in self.waits.items():
+            waits = sorted(waits)
+            stats[key] = {
+                "count": len(waits),
+                "p50": waits[int(0.5 * (len(waits) - 1))],
+                "p99": waits[int(0.99 * (len(waits) - 1))],
+                "max": waits[-1],
+            }
+        return stats
+
+    def report(self):
+        """Print the customers with the longest tail waits."""
+        stats = self.wait_stats()
+        for key in sorted(stats, key=lambda key: -stats[key]["p99"])[:5]:
+            penpal_id, customer_id = key
+            print(
+                f"Queue wait {penpal_id}/{customer_id}: "
+                f"p50 {stats[key]['p50']:.0f}s, p99 {stats[key]['p99']:.0f}s, "
+                f"max {stats[key]['max']:.0f}s ({stats[key]['count']} mails)"
+            )
@@ -0,0 +1,68 @@
+import time
+
+from mongo_client.connection import mongo_client, mongo_db_uri
+
+
+class ReprocessCheckpoint:
+    """
+    A class to handle the progress of summary reprocessing runs in a MongoDB
+    database. Every customer/penpal pair of a run has a checkpoint with the
+    partially rebuilt summary and the IDs of the emails folded into it, so
+    that an interrupted run can resume where it stopped.
+    """
+
+    def __init__(self):
+        self.mongo_db_uri = mongo_db_uri()
+
+    def get_checkpoint(self, run, customer_id, penpal_id):
+        """
+        Retrieve the checkpoint of a customer/penpal pair.
+
+        :param run: Name of the reprocessing run.
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :return: The checkpoint document, or None if not found.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.reprocess_checkpoints.find_one(
+            {"_id": f"{run}_{penpal_id}_{customer_id}"}
+        )
+
+    def save_checkpoint(self, run, customer_id, penpal_id, summary, folded, done=False):
+        """
+        Store the progress of a customer/penpal pair.
+
+        :param run: Name of the reprocessing run.
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :param summary: The summary rebuilt so far.
+        :param folded: IDs of the emails folded into the summary.
+        :param done: True when the summary has been stored.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        db.reprocess_checkpoints.replace_one(
+            {"_id": f"{run}_{penpal_id}_{customer_id}"},
+            {
+                "run": run,
+                "customer_id": customer_id,
+                "penpal_id": penpal_id,
+                "summary": summary,
+                "folded": folded,
+                "done": done,
+                "time_modified": int(time.time()),
+            },
+            upsert=True,
+        )
+
+    def clear_checkpoints(self, run):
+        """
+        Remove the checkpoints of a run so that it starts from scratch.
+
+        :param run: Name of the reprocessing run.
+        :return: Number of removed checkpoints.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.reprocess_checkpoints.delete_many({"run": run}).deleted_count
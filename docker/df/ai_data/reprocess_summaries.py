@@ -0,0 +1,237 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ai_penpal import AiPenpal
+from mongo_client.reprocess_checkpoint import ReprocessCheckpoint
+from rate_limiter import RateLimiter
+
+
+class SummaryReprocessor:
+    """
+    Rebuilds the discussion summaries of existing customers from their email
+    history, e.g. after the bullet or summary prompts have been changed.
+    Customers are processed in parallel, and the workers draw from the OpenAI
+    call budget shared with the AI service. Stored bullet points are reused, and the bullets of
+    several emails are folded into the summary with a single call. Progress
+    is checkpointed after every call, so an interrupted run resumes where
+    it stopped.
+    """
+
+    # Emails in these states have been answered or are replies
+    folded_states = {"replied", "pending", "sent"}
+
+    def __init__(self, penpal, run="default", chunk_size=10, regenerate_bullets=False):
+        """
+        :param penpal: AiPenpal whose prompts and rate limiter are used.
+        :param run: Name of the run, used to keep the checkpoints of runs apart.
+        :param chunk_size: Number of emails folded into the summary per call.
+        :param regenerate_bullets: Regenerate the bullets also for emails that have them.
+        """
+        self.penpal = penpal
+        self.mail_db = penpal.mail_db
+        self.summaries_coll = penpal.summaries_coll
+        self.checkpoints = ReprocessCheckpoint()
+        self.run = run
+        self.chunk_size = chunk_size
+        self.regenerate_bullets = regenerate_bullets
+        self.personas = {
+            persona["_id"]: persona for persona in penpal.personas.get_personas()
+        }
+
+    def initial_summary(self, customer_id, penpal_id):
+        """The summary starts from the penpal's location, like in the live loop."""
+        persona = self.personas.get(penpal_id)
+        if persona is None:
+            return ""
+        location = self.penpal.penpal_location(customer_id, persona)
+        return f"- {persona['name']} is currently living in: {location}."
+
+    def mail_bullets(self, mail):
+        """
+        Get the bullet points of an email, generating and storing them if needed.
+        Bullets of archived emails are not stored.
+
+        :raises ValueError: If no bullet points could be generated.
+        """
+        if mail.get("bullets") and not self.regenerate_bullets:
+            return mail["bullets"]
+
+        # Replies are stored as written, incoming emails may end with quoted text
+        text = mail.get("body", "")
+        if "original_mail_id" not in mail:
+            text = self.penpal.trim_email(text)
+        bullets = self.penpal.generate_bullets(text)
+        if not bullets:
+            raise ValueError(f"No bullets generated for email {mail['_id']}")
+        self.mail_db.add_mail_bullets(mail["_id"], bullets)
+
+        # Customers without a retrieval memory get theirs seeded by the live loop
+        customer_id, penpal_id = mail["customer_id"], mail["penpal_id"]
+        if self.penpal.memory.has_memory(customer_id, penpal_id):
+            self.penpal.memory.add_bullets(customer_id, penpal_id, mail["_id"], bullets)
+        return bullets
+
+    def reprocess_customer(self, customer_id, penpal_id):
+        """
+        Rebuild the summary of a customer/penpal pair from the email history.
+
+        :param customer_id: The ID of the customer.
+        :param penpal_id: The ID of the penpal.
+        :return: Number of emails folded into the summary by this call.
+        :raises ValueError: If an empty summary was generated. Nothing is stored then,
+            and the next run resumes from the last checkpoint.
+        """
+        checkpoint = self.checkpoints.get_checkpoint(self.run, customer_id, penpal_id)
+        if checkpoint and checkpoint["done"]:
+            return 0
+        if checkpoint and checkpoint["summary"]:
+            summary, folded = checkpoint["summary"], checkpoint["folded"]
+        else:
+            summary, folded = self.initial_summary(customer_id, penpal_id), []
+        seen = set(folded)
+
+        count = 0
+        # Emails answered by the live loop meanwhile are picked up by the next round
+        while True:
+            mails = [
+                mail
+                for mail in self.mail_db.find_emails_by_customer_id(
+                    customer_id, penpal_id
+                )
+                if mail["_id"] not in seen and mail.get("state") in self.folded_states
+            ]
+            if len(mails) == 0:
+                break
+            for start in range(0, len(mails), self.chunk_size):
+                chunk = mails[start : start + self.chunk_size]
+                bullets = [self.mail_bullets(mail) for mail in chunk]
+                summary = self.penpal.generate_summary(
+                    "\n".join(part for part in [summary] + bullets if part)
+                )
+                if not summary:
+                    raise ValueError(
+                        f"Empty summary generated for {penpal_id}/{customer_id}"
+                    )
+                folded += [mail["_id"] for mail in chunk]
+                seen.update(mail["_id"] for mail in chunk)
+                count += len(chunk)
+                self.checkpoints.save_checkpoint(
+                    self.run, customer_id, penpal_id, summary, folded
+                )
+
+        # Nothing to summarise, e.g. only failed emails of an inactive penpal
+        if not summary:
+            return 0
+        self.summaries_coll.update_summary(customer_id, penpal_id, summary)
+        self.checkpoints.save_checkpoint(
+            self.run, customer_id, penpal_id, summary, folded, done=True
+        )
+        return count
+
+    def reprocess(self, customers, workers=8):
+        """
+        Rebuild the summaries of customers in parallel.
+
+        :param customers: List of (penpal_id, customer_id) pairs.
+        :param workers: Number of customers processed at the same time.
+        :return: Number of customers that failed.
+        """
+        total = len(customers)
+        finished = 0
+        failed = 0
+        folded = 0
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.reprocess_customer, customer_id, penpal_id): (
+                    penpal_id,
+                    customer_id,
+                )
+                for penpal_id, customer_id in customers
+            }
+            for future in as_completed(futures):
+                penpal_id, customer_id = futures[future]
+                finished += 1
+                elapsed = time.time() - start
+                eta = elapsed / finished * (total - finished)
+                try:
+                    count = future.result()
+                    folded += count
+                    print(
+                        f"[{finished}/{total}] {penpal_id}/{customer_id}: "
+                        f"{count} emails folded, ETA {eta / 60:.0f} min"
+                    )
+                except Exception as e:
+                    # The customer is resumed from its checkpoint on the next run
+                    failed += 1
+                    print(f"[{finished}/{total}] {penpal_id}/{customer_id} failed: {e}")
+
+        print(
+            f"Reprocessed {total - failed}/{total} customers ({folded} emails) "
+            f"in {(time.time() - start) / 60:.1f} min"
+        )
+        return failed
+
+
+def main():
+    # The rebuild takes a quarter of the shared budget, and is unlimited without one
+    budget = int(os.environ.get("OPENAI_CALLS_PER_MINUTE", 40))
+    parser = argparse.ArgumentParser(
+        description="Rebuild the discussion summaries from the email history"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Customers processed in parallel"
+    )
+    parser.add_argument(
+        "--calls-per-minute",
+        type=int,
+        default=max(1, budget // 4) if budget > 0 else 0,
+        help="OpenAI calls per minute of the rebuild, taken from the budget shared "
+        "with the AI service, 0 for no limit (default: a quarter of "
+        "OPENAI_CALLS_PER_MINUTE, no limit if it is 0)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10,
+        help="Emails folded into the summary per call",
+    )
+    parser.add_argument(
+        "--run", default="default", help="Name of the run, used for the checkpoints"
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard the checkpoints of the run and start from scratch",
+    )
+    parser.add_argument("--penpal", help="Only reprocess the customers of this penpal")
+    parser.add_argument("--customer", help="Only reprocess this customer")
+    parser.add_argument(
+        "--regenerate-bullets",
+        action="store_true",
+        help="Regenerate the bullets also for emails that have them",
+    )
+    args = parser.parse_args()
+
+    penpal = AiPenpal()
+    penpal.rate_limiter = RateLimiter(args.calls_per_minute, penpal.rate_budget)
+    reprocessor = SummaryReprocessor(
+        penpal, args.run, args.chunk_size, args.regenerate_bullets
+    )
+    if args.restart:
+        removed = reprocessor.checkpoints.clear_checkpoints(args.run)
+        print(f"Removed {removed} checkpoints")
+
+    customers = penpal.mail_db.find_customers(args.penpal)
+    if args.customer:
+        customers = [pair for pair in customers if pair[1] == args.customer]
+    print(f"Reprocessing {len(customers)} customers with {args.workers} workers")
+    failed = reprocessor.reprocess(customers, args.workers)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import datetime
+import json
+import socket
+import threading
+
+import httplib2
+import metrics
+import pymongo
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+
+class CredentialManager:
+    """
+    Keeps the OAuth2 credentials of a service fresh in a background thread.
+    The token is refreshed well before it expires so that Gmail operations
+    never have to wait for a refresh. Refreshed tokens are stored in the
+    database, and tokens refreshed by other processes are picked up from there.
+    """
+
+    def __init__(self, db_conn, oauth_service, creds, refresh_margin=600):
+        """
+        :param db_conn: MailDB used for storing the token.
+        :param oauth_service: Name of the OAuth service the token belongs to.
+        :param creds: Initial credentials.
+        :param refresh_margin: Refresh the token this many seconds before it expires.
+        """
+        self.db_conn = db_conn
+        self.oauth_service = oauth_service
+        self.creds = creds
+        self.refresh_margin = refresh_margin
+        self.check_interval = 60
+        self.error = None
+        self.iteration = None
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._refreshed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"oauth-{oauth_service}", daemon=True
+        )
+
+    def start(self):
+        """Start the background refresh thread."""
+        self._thread.start()
+
+    def current(self, timeout=30):
+        """
+        Return the current credentials. Only if the token has already expired
+        (e.g. expired token at startup), wait up to timeout seconds for the
+        background thread to refresh it.
+
+        :param timeout: Maximum wait in seconds for an expired token.
+        :return: Credentials object.
+        """
+        with self._lock:
+            if self.error:
+                # Manual intervention needed
+                raise self.error
+            creds = self.creds
+        if creds.expired:
+            self._refreshed.clear()
+            self._wake.set()
+            self._refreshed.wait(timeout)
+            with self._lock:
+                if self.error:
+                    raise self.error
+                creds = self.creds
+        return creds
+
+    def _expires_in(self, creds):
+        """Seconds until the token expires, or infinity if the expiry is unknown."""
+        if creds.expiry is None:
+            return float("inf")
+        # google-auth uses naive UTC datetimes
+        return (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _adopt_shared(self):
+        """
+        Use a token stored by another process if it is newer than the current one.
+
+        :return: True if the stored token was taken into use.
+        """
+        token_data = self.db_conn.get_oauth_token(self.oauth_service)
+        if token_data is None or token_data.get("iteration") == self.iteration:
+            return False
+        self.iteration = token_data.get("iteration")
+        shared = Credentials.from_authorized_user_info(token_data["token"])
+        if self.error is None and self._expires_in(shared) <= self._expires_in(
+            self.creds
+        ):
+            return False
+        with self._lock:
+            self.creds = shared
+            self.error = None
+        print("Token taken from the database")
+        return True
+
+    def _refresh(self):
+        """Refresh the token if it expires soon and store it into the database."""
+        if self._expires_in(self.creds) > self.refresh_margin:
+            return
+        if self._adopt_shared() and self._expires_in(self.creds) > self.refresh_margin:
+            metrics.OAUTH_REFRESHES.labels("adopted").inc()
+            return
+
+        print("Token expiring: trying to refresh")
+        # Refresh a copy so that the credentials in use are never half-updated
+        creds = Credentials.from_authorized_user_info(json.loads(self.creds.to_json()))
+        creds.refresh(Request())
+        token = self.db_conn.update_oauth_token(
+            self.oauth_service, json.loads(creds.to_json())
+        )
+        with self._lock:
+            self.creds = creds
+            self.iteration = token["iteration"]
+        metrics.OAUTH_REFRESHES.labels("refreshed").inc()
+        print("Token refreshed")
+
+    def _run(self):
+        """Background loop refreshing the token, with exponential backoff on network and unexpected errors."""
+        max_delay = 300
+        base_delay = 3
+        failures = 0
+
+        while True:
+            try:
+                self._refresh()
+                failures = 0
+            except RefreshError as e:
+                # Manual intervention needed, keep polling the database for a new token
+                print("Cannot refresh the OAuth2 token")
+                metrics.OAUTH_REFRESHES.labels("error").inc()
+                with self._lock:
+                    self.error = e
+            except (
+                socket.gaierror,
+                httplib2.error.HttpLib2Error,
+                TransportError,
+                pymongo.errors.PyMongoError,
+            ) as e:
+                print(f"Network error: {e}")
+                metrics.OAUTH_REFRESHES.labels("network").inc()
+                failures += 1
+            except Exception as e:
+                # E.g. a malformed token in the database, must not end the thread
+                print(f"Unexpected error while refreshing the OAuth2 token: {e!r}")
+                metrics.OAUTH_REFRESHES.labels("unexpected").inc()
+                failures += 1
+            self._refreshed.set()
+
+            if failures > 0:
+                delay = min(max_delay, base_delay * (2 ** (failures - 1)))
+                metrics.OAUTH_BACKOFF.inc(delay)
+            else:
+                delay = self.check_interval
+            self._wake.wait(delay)
+            self._wake.clear()
@@ -1,7 +1,7 @@
-import os
 import time
 
 import pymongo
+from mongo_client.connection import mongo_client, mongo_db_uri
 
 
 class MailDB:
@@ -16,64 +16,35 @@ class MailDB:
         Initialise MailDB object by fetching database connection details from environment variables
         and constructing the MongoDB connection URI.
         """
-        db_hostname = os.environ.get("MAIL_DB_HOSTNAME")
-        db_port = os.environ.get("MAIL_DB_PORT")
-        db_name = os.environ.get("MAIL_DB_NAME")
-        db_user = os.environ.get("MAIL_DB_USER")
-        db_password = os.environ.get("MAIL_DB_PASSWORD")
-        self.mongo_db_uri = (
-            f"mongodb://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}"
-        )
-
-    def _oauth_token_exists(self, service):
-        """
-        Check if an OAuth token exists for the given service.
-        """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            return db.oauth.find_one({"service": service}) is not None
-
-    def _add_oauth_token(self, service, token):
-        """
-        Add a new OAuth token for the given service.
-        """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            temp = {
-                "service": service,
-                "token": token,
-                "time_added": int(time.time()),
-                "time_modified": int(time.time()),
-                "iteration": 1,
-            }
-
-            return db.oauth.insert_one(temp)
+        self.mongo_db_uri = mongo_db_uri()
 
     def get_oauth_token(self, service):
         """
         Get the OAuth token for the given service.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            return db.oauth.find_one({"service": service})
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.oauth.find_one({"service": service})
 
     def update_oauth_token(self, service, token):
         """
         Update the OAuth token for the given service.
         If the token does not exist, add a new one.
-        """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            if self._oauth_token_exists(service):
-                return db.oauth.update_one(
-                    {"service": service},
-                    {
-                        "$set": {"token": token, "time_modified": int(time.time())},
-                        "$inc": {"iteration": 1},
-                    },
-                )
-            else:
-                return self._add_oauth_token(service, token)
+
+        :return: The token document after the update.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        return db.oauth.find_one_and_update(
+            {"service": service},
+            {
+                "$set": {"token": token, "time_modified": int(time.time())},
+                "$setOnInsert": {"time_added": int(time.time())},
+                "$inc": {"iteration": 1},
+            },
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
 
     def save_emails(self, mails):
         """
@@ -83,14 +54,14 @@ class MailDB:
         :return: List of ObjectIds of the inserted emails.
         """
         ids = []
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
 
-            for mid in mails:
-                new_email = mails[mid]
-                ids.append(mails_db.insert_one(new_email).inserted_id)
-            return ids
+        for mid in mails:
+            new_email = mails[mid]
+            ids.append(mails_db.insert_one(new_email).inserted_id)
+        return ids
 
     def find_new_emails(self):
         """
@@ -98,10 +69,10 @@ class MailDB:
 
         :return: List of new email records.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [mail for mail in mails_db.find({"state": "new"})]
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return [mail for mail in mails_db.find({"state": "new"})]
 
     def find_emails_by_customer_id(self, customer_id):
         """
@@ -110,26 +81,30 @@ class MailDB:
         :param customer_id: Unique identifier of the customer.
         :return: List of email records associated with the given customer_id, sorted by time_added in ascending order.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [
-                mail
-                for mail in mails_db.find({"customer_id": customer_id}).sort(
-                    "time_added", pymongo.ASCENDING
-                )
-            ]
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return [
+            mail
+            for mail in mails_db.find({"customer_id": customer_id}).sort(
+                "time_added", pymongo.ASCENDING
+            )
+        ]
 
-    def outgoing_email(self):
+    def outgoing_email(self, penpal_id=None):
         """
         Find outgoing emails in the database.
 
+        :param penpal_id: Only find emails sent by this penpal (None for all penpals).
         :return: List of pending email records.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return [mail for mail in mails_db.find({"state": "pending"})]
+        query = {"state": "pending"}
+        if penpal_id is not None:
+            query["penpal_id"] = penpal_id
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return [mail for mail in mails_db.find(query)]
 
     def first_email(self, customer_id):
         """
@@ -139,12 +114,10 @@ class MailDB:
         :param customer_id: Unique identifier of the customer.
         :return: True if it's the first email for the given customer_id, otherwise False.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return (
-                len([mail for mail in mails_db.find({"customer_id": customer_id})]) < 2
-            )
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return len([mail for mail in mails_db.find({"customer_id": customer_id})]) < 2
 
     def find_email(self, mid):
         """
@@ -153,10 +126,10 @@ class MailDB:
         :param mid: Unique identifier of the email.
         :return: Email record associated with the given mid, or None if not found.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            return mails_db.find_one({"_id": mid})
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        return mails_db.find_one({"_id": mid})
 
     def add_mail_bullets(self, m_id, bullets):
         """
@@ -174,7 +147,20 @@ class MailDB:
         :param m_id: Unique identifier of the email.
         :param new_data: Dictionary containing the new data to be updated in the email record.
         """
-        with pymongo.MongoClient(self.mongo_db_uri) as client:
-            db = client.robomail
-            mails_db = db.mails
-            mails_db.update_one({"_id": m_id}, {"$set": new_data})
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails_db.update_one({"_id": m_id}, {"$set": new_data})
+
+    def assign_penpal_id(self, penpal_id):
+        """
+        Assign emails stored before multi-penpal support to the given penpal.
+
+        :param penpal_id: The ID of the penpal the emails belong to.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        mails_db = db.mails
+        mails_db.update_many(
+            {"penpal_id": {"$exists": False}}, {"$set": {"penpal_id": penpal_id}}
+        )
@@ -0,0 +1,122 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from pymongo import monitoring
+
+OPENAI_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+GMAIL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+MONGO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+CYCLE_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+WAIT_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600)
+
+OPENAI_LATENCY = Histogram(
+    "penpal_openai_request_seconds",
+    "Latency of OpenAI requests by stage",
+    ["stage"],
+    buckets=OPENAI_BUCKETS,
+)
+OPENAI_RETRIES = Counter(
+    "penpal_openai_retries_total", "Retried OpenAI requests by stage", ["stage"]
+)
+OPENAI_BACKOFF = Counter(
+    "penpal_openai_backoff_seconds_total",
+    "Time spent waiting before retrying OpenAI requests",
+    ["stage"],
+)
+OPENAI_TOKENS = Counter(
+    "penpal_openai_tokens_total", "OpenAI tokens used by stage", ["stage", "kind"]
+)
+
+GMAIL_LATENCY = Histogram(
+    "penpal_gmail_request_seconds",
+    "Latency of Gmail API calls",
+    ["method"],
+    buckets=GMAIL_BUCKETS,
+)
+OAUTH_WAIT = Histogram(
+    "penpal_oauth_wait_seconds",
+    "Time Gmail operations waited for valid OAuth credentials",
+    buckets=MONGO_BUCKETS + (10, 30),
+)
+OAUTH_REFRESHES = Counter(
+    "penpal_oauth_refreshes_total", "OAuth token refresh attempts", ["result"]
+)
+OAUTH_BACKOFF = Counter(
+    "penpal_oauth_backoff_seconds_total",
+    "Time spent waiting before retrying OAuth token refreshes",
+)
+
+MONGO_LATENCY = Histogram(
+    "penpal_mongo_command_seconds",
+    "Latency of MongoDB commands",
+    ["command"],
+    buckets=MONGO_BUCKETS,
+)
+MONGO_FAILURES = Counter(
+    "penpal_mongo_command_failures_total", "Failed MongoDB commands", ["command"]
+)
+
+QUEUE_DEPTH = Gauge("penpal_mails", "Mails in the mails collection by state", ["state"])
+REPLY_WAIT = Histogram(
+    "penpal_reply_wait_seconds",
+    "Time from the arrival of a mail to the reply",
+    ["penpal_id"],
+    buckets=WAIT_BUCKETS,
+)
+
+POLL_CYCLE = Histogram(
+    "penpal_poll_cycle_seconds",
+    "Duration of polling cycles",
+    ["loop"],
+    buckets=CYCLE_BUCKETS,
+)
+POLL_ITEMS = Counter("penpal_poll_items_total", "Items processed by polling", ["loop"])
+POLL_DECISIONS = Counter(
+    "penpal_poll_decisions_total", "Polling scheduler decisions", ["loop", "decision"]
+)
+POLL_INTERVAL = Gauge(
+    "penpal_poll_delay_seconds", "Delay until the next polling cycle", ["loop"]
+)
+QUEUE_LATENCY = Histogram(
+    "penpal_queue_latency_seconds",
+    "Time from the arrival of an item to its processing by polling",
+    ["loop"],
+    buckets=WAIT_BUCKETS,
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records the latency of every MongoDB command of the process."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(event.command_name).inc()
+
+
+def record_openai_usage(stage, response):
+    """
+    Count the tokens used by an OpenAI response.
+
+    :param stage: Name of the stage that made the request.
+    :param response: OpenAI API response.
+    """
+    usage = response.get("usage", {})
+    OPENAI_TOKENS.labels(stage, "prompt").inc(usage.get("prompt_tokens", 0))
+    OPENAI_TOKENS.labels(stage, "completion").inc(usage.get("completion_tokens", 0))
+
+
+def start_metrics_server(port):
+    """
+    Export the metrics in Prometheus text format over HTTP and start recording
+    the MongoDB commands. Must be called before any MongoClient is created.
+
+    :param port: Port of the metrics endpoint, 0 disables the endpoint.
+    """
+    monitoring.register(MongoCommandMetrics())
+    if port:
+        start_http_server(port)
+        print(f"Metrics available on port {port}")
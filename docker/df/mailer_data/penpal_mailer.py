@@ -2,18 +2,19 @@ import base64
 import json
 import os
 import random
-import socket
 import time
 from email.mime.text import MIMEText
 from functools import wraps
 
-import httplib2
-from google.auth.exceptions import RefreshError
-from google.auth.transport.requests import Request
+import metrics
+from credential_manager import CredentialManager
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from mongo_client.maildb import MailDB
+from mongo_client.persona_db import PersonaDB
+from polling_scheduler import PollingScheduler
+from profiling import CycleProfiler
 
 
 class PenpalMailer:
@@ -21,130 +22,189 @@ class PenpalMailer:
 
     accepted_types = {"text/plain", "text/html"}
 
-    def __init__(self):
-        scopes = [
-            "https://www.googleapis.com/auth/gmail.readonly",
-            "https://www.googleapis.com/auth/gmail.compose",
-            "https://www.googleapis.com/auth/gmail.modify",
-        ]
+    scopes = [
+        "https://www.googleapis.com/auth/gmail.readonly",
+        "https://www.googleapis.com/auth/gmail.compose",
+        "https://www.googleapis.com/auth/gmail.modify",
+    ]
 
-        self.penpal_id = os.environ.get("PENPAL_ID")
-        self.penpal_name = os.environ.get("PENPAL_NAME")
-        self.penpal_email = os.environ.get("PENPAL_EMAIL")
-        self.oauth_service = os.environ.get("OAUTH_SERVICE")
+    def __init__(self):
+        # Refresh the tokens this many seconds before they expire
+        self.refresh_margin = int(os.environ.get("OAUTH_REFRESH_MARGIN", 600))
 
         # ok to crash here
         self.polling_interval = int(os.environ.get("EMAIL_POLLING_INTERVAL"))
+        self.scheduler = PollingScheduler(
+            "mail",
+            self.polling_interval,
+            int(os.environ.get("EMAIL_POLLING_MIN_INTERVAL", 0)),
+            int(os.environ.get("EMAIL_POLLING_MAX_INTERVAL", 0)),
+        )
+        # Profiling runs are started with SIGUSR1 or PROFILE_ON_START
+        self.profiler = CycleProfiler(
+            "mail",
+            int(os.environ.get("PROFILE_CYCLES", 5)),
+            os.environ.get("PROFILE_DIR", "/tmp/profiles"),
+        )
+        if os.environ.get("PROFILE_ON_START") == "1":
+            self.profiler.request()
+        # Messages fetched from the inbox per cycle (Gmail allows up to 500)
+        self.batch_size = int(os.environ.get("EMAIL_BATCH_SIZE", 100))
 
         self.db_conn = MailDB()
+        self.personas = PersonaDB()
+        # One credential manager per OAuth service, shared by the penpals using it
+        self.credentials = {}
+        # Rotates the penpal served first on each cycle
+        self.cycle = 0
+
+        # Mails from before multi-penpal support belong to the penpal of the environment
+        if os.environ.get("PENPAL_ID"):
+            self.db_conn.assign_penpal_id(os.environ.get("PENPAL_ID"))
+
+    def credential_manager(self, persona):
+        """
+        Get the credential manager of a penpal's mailbox, starting it on first use.
+        The token is read from the database, the persona definition or token.json,
+        in this order. token.json holds the mailbox of the environment penpal, so it
+        is only used for the OAUTH_SERVICE of the environment.
 
-        token_data = self.db_conn.get_oauth_token(self.oauth_service)
+        :raises ValueError: If no token is found for the penpal.
+        """
+        oauth_service = persona["oauth_service"]
+        if oauth_service not in self.credentials:
+            token_data = self.db_conn.get_oauth_token(oauth_service)
+
+            if token_data:
+                creds = Credentials.from_authorized_user_info(token_data["token"])
+            elif persona.get("token"):
+                creds = Credentials.from_authorized_user_info(persona["token"])
+                self.db_conn.update_oauth_token(oauth_service, persona["token"])
+            elif oauth_service == os.environ.get("OAUTH_SERVICE"):
+                with open("token.json", "r") as token_file:
+                    creds = Credentials.from_authorized_user_file(
+                        "token.json", self.scopes
+                    )
+                    token_json = json.load(token_file)
+                    self.db_conn.update_oauth_token(oauth_service, token_json)
+            else:
+                raise ValueError(
+                    f"No OAuth2 token for penpal {persona['_id']}: add a token to "
+                    f"the persona or to the oauth collection as {oauth_service}"
+                )
 
-        if token_data:
-            self.creds = Credentials.from_authorized_user_info(token_data["token"])
-        else:
-            with open("token.json", "r") as token_file:
-                self.creds = Credentials.from_authorized_user_file("token.json", scopes)
-                token_json = json.load(token_file)
-                self.db_conn.update_oauth_token(self.oauth_service, token_json)
+            manager = CredentialManager(
+                self.db_conn, oauth_service, creds, self.refresh_margin
+            )
+            manager.start()
+            self.credentials[oauth_service] = manager
+        return self.credentials[oauth_service]
 
     def wait(self):
-        """Pause execution for the specified polling interval."""
-        time.sleep(self.polling_interval + random.random())
+        """Pause execution for the adaptive polling interval."""
+        self.scheduler.wait()
 
     def token_refresh(func):
         """
-        Decorator for refreshing the OAuth2 token
+        Decorator for using the latest OAuth2 token.
+        The token is refreshed ahead of expiry by the CredentialManager.
+        Records the time spent waiting for the token.
         """
 
         @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            max_retries = 8
-            base_delay = 3
-
-            if self.creds.expired:
-                for i in range(max_retries):
-                    print("Token expired: trying to refresh")
-                    try:
-                        self.creds.refresh(Request())
-                        print("Token refreshed")
-                        # Store the refreshed token into the database
-                        token_data = json.loads(self.creds.to_json())
-                        self.db_conn.update_oauth_token(self.oauth_service, token_data)
-                        break
-                    except RefreshError as e:
-                        # Manual intervention needed
-                        print("Cannot refresh the OAuth2 token")
-                        raise e
-                    except (socket.gaierror, httplib2.error.HttpLib2Error) as e:
-                        if i == max_retries - 1:
-                            print("Max retries exceeded")
-                            raise e
-
-                        print(f"Network error: {e}")
-                        time.sleep(base_delay * (2**i))
-                        print("Waiting done")
-            else:
-                print("Token not expired")
-
-            return func(self, *args, **kwargs)
+        def wrapper(self, persona, *args, **kwargs):
+            with self.profiler.stage("oauth_wait"), metrics.OAUTH_WAIT.time():
+                self.creds = self.credential_manager(persona).current()
+            with self.profiler.stage(func.__name__):
+                return func(self, persona, *args, **kwargs)
 
         return wrapper
 
+    def execute(self, request, method):
+        """
+        Execute a Gmail API request and record its latency.
+
+        :param request: The HttpRequest to execute.
+        :param method: Name of the API method, e.g. messages.get.
+        :return: The response of the request.
+        """
+        with metrics.GMAIL_LATENCY.labels(method).time():
+            return request.execute()
+
     @token_refresh
-    def send_mail(self):
-        """Send outgoing emails stored in the database (state == 'pending')."""
-        outgoing = self.db_conn.outgoing_email()
+    def send_mail(self, persona):
+        """
+        Send outgoing emails of a penpal stored in the database (state == 'pending').
+
+        :return: Queue latencies in seconds of the sent emails.
+        """
+        latencies = []
+        outgoing = self.db_conn.outgoing_email(persona["_id"])
         for email in outgoing:
-            penpal_email_local, penpal_email_domain = self.penpal_email.split("@")
+            penpal_email_local, penpal_email_domain = persona["email"].split("@")
 
             message_id = email["_id"]
             message = MIMEText(email["body"])
             message["to"] = email["From"]
             message[
                 "from"
-            ] = f"{self.penpal_name} <{penpal_email_local}+{email['customer_id']}@{penpal_email_domain}>"
+            ] = f"{persona['name']} <{penpal_email_local}+{email['customer_id']}@{penpal_email_domain}>"
             message["subject"] = f"Re: {email['Subject']}"
 
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
 
             try:
                 with build("gmail", "v1", credentials=self.creds) as service:
-                    sent_message = (
+                    sent_message = self.execute(
                         service.users()
                         .messages()
-                        .send(userId="me", body={"raw": raw_message})
-                        .execute()
+                        .send(userId="me", body={"raw": raw_message}),
+                        "messages.send",
                     )
                     self.db_conn.update_email(message_id, {"state": "sent"})
+                    latencies.append(time.time() - email["time_added"])
                     print(f'Message sent. Message ID: {sent_message["id"]}')
             except HttpError as error:
                 print(f"An error occurred: {error}")
+        return latencies
 
-    @token_refresh
-    def archive_downloaded(self, message_ids):
-        """Archive downloaded emails by removing the 'INBOX' label."""
+    def archive_downloaded(self, persona, message_ids):
+        """
+        Archive downloaded emails by removing the 'INBOX' label.
+        Only called from check_mail, which has already fetched the current token.
+        """
         try:
             with build("gmail", "v1", credentials=self.creds) as service:
-                labels = service.users().labels().list(userId="me").execute()
+                labels = self.execute(
+                    service.users().labels().list(userId="me"), "labels.list"
+                )
                 inbox_label_id = None
                 for label in labels["labels"]:
                     if label["name"] == "INBOX":
                         inbox_label_id = label["id"]
                         break
                 for message_id in message_ids:
-                    service.users().messages().modify(
-                        userId="me",
-                        id=message_id,
-                        body={"removeLabelIds": [inbox_label_id]},
-                    ).execute()
+                    self.execute(
+                        service.users()
+                        .messages()
+                        .modify(
+                            userId="me",
+                            id=message_id,
+                            body={"removeLabelIds": [inbox_label_id]},
+                        ),
+                        "messages.modify",
+                    )
 
         except HttpError as error:
             print(f"An error occurred: {error}")
 
     @token_refresh
-    def check_mail(self):
-        """Fetch new emails from the inbox and save them to the database."""
+    def check_mail(self, persona):
+        """
+        Fetch new emails from the inbox of a penpal and save them to the database.
+
+        :return: Number of fetched emails.
+        """
         try:
             with build("gmail", "v1", credentials=self.creds) as service:
 
@@ -153,27 +213,29 @@ class PenpalMailer:
                 data = {}
 
                 # Fetches all messages that are in the inbox (== not archived)
-                results = (
-                    service.users().messages().list(userId="me", q="in:inbox").execute()
+                results = self.execute(
+                    service.users()
+                    .messages()
+                    .list(userId="me", q="in:inbox", maxResults=self.batch_size),
+                    "messages.list",
                 )
                 if "messages" not in results:
                     print("No new mail")
-                    return
+                    return 0
                 for message in results["messages"]:
                     mid = message["id"]
                     data[mid] = {}
                     data[mid]["time_added"] = int(time.time())
 
-                    mail = (
-                        service.users()
-                        .messages()
-                        .get(userId="me", id=message["id"])
-                        .execute()
+                    mail = self.execute(
+                        service.users().messages().get(userId="me", id=message["id"]),
+                        "messages.get",
                     )
                     for header in mail["payload"]["headers"]:
                         if header["name"] in headers:
                             data[mid][header["name"]] = header["value"]
-                    data[mid]["_id"] = f"{self.penpal_id}_{mid}"
+                    data[mid]["_id"] = f"{persona['_id']}_{mid}"
+                    data[mid]["penpal_id"] = persona["_id"]
 
                     # Customer ID must be present in the as address tag, otherwise the email data is not processed further
                     if "+" in data[mid]["To"]:
@@ -184,25 +246,26 @@ class PenpalMailer:
                     else:
                         data[mid]["customer_id"] = None
                         data[mid]["state"] = "error"
-                    parts = mail["payload"].get("parts", [])
-                    if len(parts) == 0:
-                        if mail["payload"]["mimeType"] in self.accepted_types:
-                            data[mid]["body"] = base64.urlsafe_b64decode(
-                                mail["payload"]["body"]["data"]
-                            ).decode("utf-8")
-                    else:
-                        for part in mail["payload"]["parts"]:
-                            if part["mimeType"] in self.accepted_types:
-                                # text/plain is prioritised
-                                if part["mimeType"] == "text/plain":
-                                    data[mid]["body"] = base64.urlsafe_b64decode(
-                                        part["body"]["data"]
-                                    ).decode("utf-8")
-                                    break
-                                elif part["mimeType"] == "text/html":
-                                    data[mid]["body"] = base64.urlsafe_b64decode(
-                                        part["body"]["data"]
-                                    ).decode("utf-8")
+                    with self.profiler.stage("decode_body"):
+                        parts = mail["payload"].get("parts", [])
+                        if len(parts) == 0:
+                            if mail["payload"]["mimeType"] in self.accepted_types:
+                                data[mid]["body"] = base64.urlsafe_b64decode(
+                                    mail["payload"]["body"]["data"]
+                                ).decode("utf-8")
+                        else:
+                            for part in mail["payload"]["parts"]:
+                                if part["mimeType"] in self.accepted_types:
+                                    # text/plain is prioritised
+                                    if part["mimeType"] == "text/plain":
+                                        data[mid]["body"] = base64.urlsafe_b64decode(
+                                            part["body"]["data"]
+                                        ).decode("utf-8")
+                                        break
+                                    elif part["mimeType"] == "text/html":
+                                        data[mid]["body"] = base64.urlsafe_b64decode(
+                                            part["body"]["data"]
+                                        ).decode("utf-8")
                     # The message is not processed further if no text is found or the text is suspiciously long
                     if (
                         "body" not in data[mid]
@@ -210,18 +273,52 @@ class PenpalMailer:
                     ):
                         data[mid]["state"] = "error"
                 # Save the processed email data to the database
-                self.db_conn.save_emails(data)
+                with self.profiler.stage("save_emails"):
+                    self.db_conn.save_emails(data)
                 # Archive the downloaded messages in Gmail
-                self.archive_downloaded(list(data.keys()))
+                with self.profiler.stage("archive_downloaded"):
+                    self.archive_downloaded(persona, list(data.keys()))
+                return len(data)
 
         except HttpError as error:
             print(f"An error occurred: {error}")
+            return 0
+
+    def poll(self):
+        """
+        Check and send the mail of every penpal once. The penpal served first
+        rotates between cycles so that every mailbox gets its turn first.
+        Failures are logged per penpal, and the other penpals are still served.
+        """
+        self.scheduler.start_cycle()
+        self.profiler.start_cycle()
+        personas = self.personas.get_personas()
+        start = self.cycle % max(1, len(personas))
+        self.cycle += 1
+
+        items = 0
+        backlog = False
+        latencies = []
+        for persona in personas[start:] + personas[:start]:
+            fetched = 0
+            try:
+                fetched = self.check_mail(persona)
+                with self.profiler.stage("throttle"):
+                    time.sleep(random.random())
+                latencies += self.send_mail(persona)
+            except Exception as e:
+                # A broken mailbox (e.g. a revoked token) must not stop the other penpals
+                print(f"Cannot serve penpal {persona['_id']}: {e!r}")
+            items += fetched
+            # A full page of messages means that the inbox may still have more
+            backlog = backlog or fetched >= self.batch_size
+        self.scheduler.record(items + len(latencies), backlog, latencies)
+        self.profiler.end_cycle()
 
 
 if __name__ == "__main__":
+    metrics.start_metrics_server(int(os.environ.get("METRICS_PORT", 0)))
     mailer = PenpalMailer()
     while True:
-        mailer.check_mail()
-        time.sleep(random.random())
-        mailer.send_mail()
+        mailer.poll()
         mailer.wait()
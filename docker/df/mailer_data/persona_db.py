@@ -0,0 +1,51 @@
+import os
+
+from mongo_client.connection import mongo_client, mongo_db_uri
+
+
+class PersonaDB:
+    """
+    A class to handle penpal persona definitions in a MongoDB database.
+    A single process serves every active persona of the personas collection:
+
+        {
+            "_id": penpal ID,
+            "name": name of the penpal,
+            "email": Gmail address of the penpal,
+            "oauth_service": key of the penpal's OAuth token in the oauth collection,
+            "token": initial OAuth token (optional),
+            "locations": location pool of the penpal (optional),
+            "active": False to stop serving the penpal (optional),
+        }
+
+    If the collection is empty, the persona defined by the PENPAL_* environment
+    variables is served. If every persona is inactive, no persona is served.
+    """
+
+    def __init__(self):
+        self.mongo_db_uri = mongo_db_uri()
+
+    def default_persona(self):
+        """
+        Build the persona defined by the environment variables.
+
+        :return: Persona document.
+        """
+        return {
+            "_id": os.environ.get("PENPAL_ID"),
+            "name": os.environ.get("PENPAL_NAME"),
+            "email": os.environ.get("PENPAL_EMAIL"),
+            "oauth_service": os.environ.get("OAUTH_SERVICE"),
+        }
+
+    def get_personas(self):
+        """
+        Get the active personas.
+
+        :return: List of persona documents, sorted by penpal ID.
+        """
+        client = mongo_client(self.mongo_db_uri)
+        db = client.robomail
+        if db.personas.count_documents({}) == 0:
+            return [self.default_persona()]
+        return list(db.personas.find({"active": {"$ne": False}}).sort("_id"))
@@ -0,0 +1,93 @@
+import random
+import time
+
+import metrics
+
+
+class PollingScheduler:
+    """
+    Adaptive polling interval for the service loops.
+    The interval is shortened while work keeps arriving and backed off
+    exponentially toward a ceiling while the service is idle. When a cycle
+    could not process everything (a backlog), the next cycle starts right away.
+    """
+
+    def __init__(self, name, interval, min_interval=None, max_interval=None):
+        """
+        :param name: Name of the polling loop, used in the log output.
+        :param interval: Initial polling interval in seconds.
+        :param min_interval: Shortest interval while busy (default: interval / 8).
+        :param max_interval: Longest interval while idle (default: interval * 4).
+        """
+        self.name = name
+        self.min_interval = min_interval or max(1, interval / 8)
+        self.max_interval = max_interval or interval * 4
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.backoff = 2
+        self.delay = self.interval
+        self.decision = None
+        self.cycle_start = time.time()
+        self.stats = {
+            "cycles": 0,
+            "items": 0,
+            "decisions": {"drain": 0, "busy": 0, "idle": 0},
+            "last_cycle_items": 0,
+            "last_cycle_duration": 0.0,
+            "last_queue_latency_max": 0.0,
+            "last_queue_latency_mean": 0.0,
+        }
+
+    def start_cycle(self):
+        """Mark the start of a polling cycle."""
+        self.cycle_start = time.time()
+
+    def record(self, items, backlog=False, latencies=()):
+        """
+        Record the outcome of a polling cycle and decide when to poll next.
+
+        :param items: Number of items processed in the cycle.
+        :param backlog: True if there are items left that the cycle did not process.
+        :param latencies: Queue latencies (seconds from arrival to processing) of the items.
+        :return: Delay in seconds until the next cycle.
+        """
+        if backlog:
+            self.decision = "drain"
+            self.delay = 0
+        elif items > 0:
+            self.decision = "busy"
+            self.interval = max(self.min_interval, self.interval / self.backoff)
+            self.delay = self.interval
+        else:
+            self.decision = "idle"
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+            self.delay = self.interval
+
+        latencies = list(latencies)
+        self.stats["cycles"] += 1
+        self.stats["items"] += items
+        self.stats["decisions"][self.decision] += 1
+        self.stats["last_cycle_items"] = items
+        self.stats["last_cycle_duration"] = time.time() - self.cycle_start
+        self.stats["last_queue_latency_max"] = max(latencies, default=0.0)
+        self.stats["last_queue_latency_mean"] = (
+            sum(latencies) / len(latencies) if latencies else 0.0
+        )
+
+        metrics.POLL_CYCLE.labels(self.name).observe(self.stats["last_cycle_duration"])
+        metrics.POLL_ITEMS.labels(self.name).inc(items)
+        metrics.POLL_DECISIONS.labels(self.name, self.decision).inc()
+        metrics.POLL_INTERVAL.labels(self.name).set(self.delay)
+        for latency in latencies:
+            metrics.QUEUE_LATENCY.labels(self.name).observe(latency)
+
+        print(
+            f"{self.name}: {items} items in {self.stats['last_cycle_duration']:.1f}s, "
+            f"queue latency max {self.stats['last_queue_latency_max']:.0f}s, "
+            f"{self.decision}: next poll in {self.delay:.0f}s"
+        )
+        return self.delay
+
+    def wait(self):
+        """Pause execution until the next cycle, with jitter unless draining a backlog."""
+        if self.delay > 0:
+            time.sleep(self.delay + random.random())